@@ -1,8 +1,25 @@
 import sqlite3
 import json
+import threading
 import time
+import urllib.parse
+import urllib.request
+import contextlib
+import functools
 import datetime
+import fnmatch
+import hashlib
+import io
+import lzma
+import os
+import queue
+import re
 import validators
+import zlib
+import metrics
+import sqltrace
+from query import Query
+from resultset import ResultSet
 
 
 class ArquiveError(Exception):
@@ -14,8 +31,90 @@ class IDNotFound(ArquiveError):
 
 
 class Tags:
-    def __init__(self):
-        pass
+    def __init__(self, connection):
+        self.con = connection
+
+        # Inverted index of the tags of every visible entry. The JSON column in entries is still
+        # the source of truth, this table is what searches run against
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entry_tags(
+                entry_id INTEGER,                       -- entry with the tag
+                tag TEXT,                               --
+                PRIMARY KEY(entry_id, tag)
+            ) WITHOUT ROWID
+            """
+        )
+
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS entry_tags_tag ON entry_tags(tag, entry_id)"
+        )
+
+        # Named tags of visible entries whose value is a number, like score:4, as real numbers. Range
+        # queries on a key read a single range of the primary key
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entry_numbers(
+                key TEXT,                               -- part of the tag before the last ':'
+                value REAL,                             -- part after it, as a number
+                entry_id INTEGER,                       -- entry with the tag
+                PRIMARY KEY(key, value, entry_id)
+            ) WITHOUT ROWID
+            """
+        )
+
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS entry_numbers_entry ON entry_numbers(entry_id)"
+        )
+
+        # How many visible entries have each tag, split into key and value for named tags like
+        # author:x. Plain tags have no key. Triggers keep the counts in step with the index
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tag_counts(
+                tag TEXT PRIMARY KEY,                   --
+                key TEXT,                               -- part before the last ':', if any
+                value TEXT,                             -- part after it
+                count INTEGER                           -- visible entries with the tag
+            ) WITHOUT ROWID
+            """
+        )
+
+        self.con.execute(
+            """
+            CREATE INDEX IF NOT EXISTS tag_counts_key ON tag_counts(key, count)
+                WHERE key IS NOT NULL
+            """
+        )
+
+        self.con.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS entry_tags_count AFTER INSERT ON entry_tags BEGIN
+                INSERT INTO tag_counts(tag, key, value, count)
+                    VALUES(NEW.tag, %s, %s, 1)
+                    ON CONFLICT(tag) DO UPDATE SET count = count + 1;
+            END
+            """
+            % self.split_sql("NEW.tag")
+        )
+
+        self.con.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS entry_tags_uncount AFTER DELETE ON entry_tags BEGIN
+                UPDATE tag_counts SET count = count - 1 WHERE tag = OLD.tag;
+                DELETE FROM tag_counts WHERE tag = OLD.tag AND count <= 0;
+            END
+            """
+        )
+
+    # SQL expressions for the key and the value of a tag, split at its last ':'. Trimming every
+    # character but ':' from the right of a tag leaves everything up to the last ':'
+    def split_sql(self, tag):
+        prefix = "rtrim({0}, replace({0}, ':', ''))".format(tag)
+        key = "NULLIF(substr({0}, 1, length({0}) - 1), '')".format(prefix)
+        value = "substr({0}, length({1}) + 1)".format(tag, prefix)
+
+        return key, value
 
     def update(self, old, dif):
         if isinstance(dif, dict):
@@ -51,16 +150,42 @@ class Tags:
 
         return set(json.loads(value))
 
+    # Tags with * or ? are patterns: * stands for any number of characters, and ? for any single
+    # one. A value of just ?, like in author:?, stands for any value
+    def is_pattern(self, tag):
+        return "*" in tag or "?" in tag
+
+    # Turns a pattern into a GLOB pattern, along with the part before the first wildcard
+    def glob(self, tag):
+        if tag.endswith(":?"):
+            tag = tag[:-1] + "*"
+
+        # [ is a wildcard for GLOB, but not for us
+        glob = tag.replace("[", "[[]")
+        prefix = tag.split("*")[0].split("?")[0]
+
+        return glob, prefix
+
+    def has(self, value, tag):
+        # Tags like 2020 are parsed as numbers
+        tag = str(tag)
+
+        if not self.is_pattern(tag):
+            return tag in value
+
+        glob, _ = self.glob(tag)
+        return any(fnmatch.fnmatchcase(v, glob) for v in value)
+
     def match_all(self, value, tags):
         for v in tags:
-            if not v in value:
+            if not self.has(value, v):
                 return False
 
         return True
 
     def match_any(self, value, tags):
         for v in tags:
-            if v in value:
+            if self.has(value, v):
                 return True
 
         return False
@@ -74,10 +199,231 @@ class Tags:
 
         return self.match_all(value, pattern)
 
+    # Adds the packed tags of an entry to the index
+    def index(self, entry_id, value):
+        self.index_many([(entry_id, value)])
+
+    # Same as index, for many (entry_id, value) pairs at once
+    def index_many(self, entries):
+        rows = [(entry_id, tag) for entry_id, value in entries for tag in self.unpack(value)]
+
+        self.con.executemany("INSERT OR IGNORE INTO entry_tags(entry_id, tag) VALUES(?, ?)", rows)
+        self.con.executemany(
+            "INSERT OR IGNORE INTO entry_numbers(key, value, entry_id) VALUES(?, ?, ?)",
+            [(*number, entry_id) for entry_id, tag in rows for number in [self.number(tag)] if number],
+        )
+
+    def unindex(self, entry_id):
+        self.con.execute("DELETE FROM entry_tags WHERE entry_id = ?", [entry_id])
+        self.con.execute("DELETE FROM entry_numbers WHERE entry_id = ?", [entry_id])
+
+    # Splits a named tag with a numeric value, like score:4, into its key and the number. Other tags
+    # give None
+    def number(self, tag):
+        key, _, value = tag.rpartition(":")
+
+        if not key or not re.fullmatch(r"-?\d+(\.\d+)?", value):
+            return None
+
+        return key, float(value)
+
+    # Checks the numeric tags of an entry against (key, operator, number) comparisons
+    def compare(self, value, comparisons):
+        numbers = [n for n in map(self.number, value) if n]
+
+        for key, op, number in comparisons:
+            if not any(k == key and self.operators[op](v, number) for k, v in numbers):
+                return False
+
+        return True
+
+    operators = {
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "=": lambda a, b: a == b,
+    }
+
+    # SQL counterpart of compare. Each comparison is a range of the entry_numbers primary key
+    def compare_where(self, comparisons):
+        clauses = []
+        params = []
+
+        for key, op, number in comparisons:
+            assert op in self.operators, "Cannot compare with %s" % op
+
+            clauses.append(
+                "entries.id IN (SELECT entry_id FROM entry_numbers WHERE key = ? AND value %s ?)"
+                % op
+            )
+            params += [key, number]
+
+        return " AND ".join(clauses) or "1", params
+
+    # SQL counterpart of match. Required tags are an intersection of index lookups, and forbidden
+    # ones are subtracted from it
+    def where(self, pattern):
+        if isinstance(pattern, dict):
+            yes = pattern.get("add", [])
+            no = pattern.get("sub", [])
+        else:
+            yes, no = pattern, []
+
+        # Tags like 2020 are parsed as numbers
+        yes = [str(tag) for tag in yes]
+        no = [str(tag) for tag in no]
+
+        if not yes and not no:
+            return "1", []
+
+        params = []
+
+        def tag_sql(tag):
+            clause, values = self.tag_where(tag)
+            params.extend(values)
+            return "SELECT entry_id FROM entry_tags WHERE %s" % clause
+
+        if not yes:
+            sql = " UNION ".join(tag_sql(tag) for tag in no)
+            return "entries.id NOT IN (%s)" % sql, params
+
+        sql = " INTERSECT ".join(tag_sql(tag) for tag in yes)
+
+        if no:
+            sql += " EXCEPT %s" % " UNION ".join(tag_sql(tag) for tag in no)
+
+        return "entries.id IN (%s)" % sql, params
+
+    # Condition on entry_tags.tag for a single tag or pattern. A pattern is first expanded into the
+    # tags it matches, from the sorted distinct tags in tag_counts. Only the range of tags that
+    # start like the pattern is read, never the entries
+    def tag_where(self, tag):
+        if not self.is_pattern(tag):
+            return "tag = ?", [tag]
+
+        glob, prefix = self.glob(tag)
+        sql = "SELECT tag FROM tag_counts WHERE tag GLOB ?"
+        params = [glob]
+
+        if prefix:
+            # Every tag that starts with prefix sorts before the prefix with its last character
+            # bumped up
+            sql += " AND tag >= ? AND tag < ?"
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+        return "tag IN (%s)" % sql, params
+
+
+# Reads up to size bytes, even if the stream returns them in smaller pieces
+def read_chunk(stream, size):
+    chunk = stream.read(size)
+
+    while chunk and len(chunk) < size:
+        more = stream.read(size - len(chunk))
+        if not more:
+            break
+
+        chunk += more
+
+    return chunk
+
+
+# Codecs blobs can be compressed with, as (compress, decompress)
+codecs = {
+    "raw": (lambda data: data, lambda data: data),
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+# Signatures of formats that are already compressed, and wouldn't get any smaller
+compressed_formats = [
+    b"\x89PNG",  # png
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",  # gif
+    b"RIFF",  # webp, wav, avi
+    b"PK\x03\x04",  # zip, docx, epub, jar...
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ",  # xz
+    b"7z\xbc\xaf",  # 7z
+    b"Rar!",  # rar
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"ID3",  # mp3
+    b"OggS",  # ogg
+    b"fLaC",  # flac
+]
+
+
+# Read only file handle over a stored blob. Chunks are fetched from the database as they are
+# needed, so reading a big file never holds more than one chunk in memory. Connections are only
+# borrowed from the reader while fetching a chunk
+class BlobFile(io.RawIOBase):
+    def __init__(self, reader, blob_id, size, chunk_size):
+        self.reader = reader
+        self.blob_id = blob_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+        # Last chunk read, as (seq, data)
+        self.current = (None, b"")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = max(start + offset, 0)
+
+        return self.pos
+
+    # Each chunk is read along with its codec, since compress_files may compress the blob while
+    # it's being read
+    def chunk(self, seq):
+        if self.current[0] != seq:
+            with self.reader() as con:
+                (data, codec) = con.execute(
+                    "SELECT data, codec FROM blob_chunks WHERE blob = ? AND seq = ?",
+                    [self.blob_id, seq],
+                ).fetchone()
+
+            self.current = (seq, codecs[codec or "raw"][1](data))
+
+        return self.current[1]
+
+    def readinto(self, buffer):
+        done = 0
+
+        while done < len(buffer) and self.pos < self.size:
+            seq, offset = divmod(self.pos, self.chunk_size)
+            chunk = self.chunk(seq)
+
+            n = min(len(buffer) - done, len(chunk) - offset)
+            buffer[done : done + n] = chunk[offset : offset + n]
+            done += n
+            self.pos += n
+
+        return done
+
 
 class Files:
-    def __init__(self, connection):
+    # Size of the pieces file contents are stored in
+    chunk_size = 256 * 1024
+
+    # Codec used for content that compresses well, and how much smaller it must get to be worth it
+    codec = "zlib"
+    min_ratio = 0.9
+
+    def __init__(self, connection, reader):
         self.con = connection
+        self.reader = reader
 
         self.con.execute(
             """
@@ -85,7 +431,35 @@ class Files:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,   
                 name TEXT,                              -- name of the file
                 size INT,                               -- file size
-                data BLOB                               -- content
+                blob INTEGER,                           -- content
+                FOREIGN KEY(blob) REFERENCES blobs(id)
+            )
+            """
+        )
+
+        # File contents, stored once no matter how many files share them
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hash TEXT UNIQUE,                       -- sha256 of the content
+                size INT,                               -- content size
+                refs INT DEFAULT 0,                     -- number of files with this content
+                chunk_size INT,                         -- size of every chunk but the last
+                codec TEXT                              -- compression used by the chunks
+            )
+            """
+        )
+
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blob_chunks(
+                blob INTEGER,                           -- blob this chunk belongs to
+                seq INTEGER,                            -- position of the chunk in the blob
+                data BLOB,                              --
+                codec TEXT,                             -- compression used by this chunk
+                PRIMARY KEY(blob, seq),
+                FOREIGN KEY(blob) REFERENCES blobs(id)
             )
             """
         )
@@ -93,37 +467,154 @@ class Files:
     def update(self, old, dif):
         return self.pack(dif)
 
-    def pack(self, value):
-        if not value:
-            return None
+    # Picks how to compress a blob from a sample of its content
+    def choose_codec(self, sample):
+        if not self.codec or not sample:
+            return "raw"
 
-        name, data = value
-        assert isinstance(name, str)
-        assert isinstance(data, bytes)
+        if any(sample.startswith(magic) for magic in compressed_formats):
+            return "raw"
+
+        # mp4, mov and friends
+        if sample[4:8] == b"ftyp":
+            return "raw"
+
+        # A fast compression of a small piece tells us well enough if it's worth it
+        sample = sample[: 64 * 1024]
+        if len(zlib.compress(sample, 1)) > len(sample) * self.min_ratio:
+            return "raw"
+
+        return self.codec
+
+    def find_blob(self, hash):
+        return self.con.execute("SELECT id, size FROM blobs WHERE hash = ?", [hash]).fetchone()
+
+    # Returns the id and size of the blob with this content, storing it if it's new. The content can
+    # be either bytes or a binary file, which is copied in chunks. Knowing the content's sha256
+    # beforehand saves copying it when it's already stored
+    def store(self, data, sha256=None):
+        if isinstance(data, bytes):
+            sha256 = hashlib.sha256(data).hexdigest()
+            data = io.BytesIO(data)
+
+        if sha256:
+            blob = self.find_blob(sha256)
+            if blob:
+                return blob
 
-        size = len(data)
+        self.con.execute("INSERT INTO blobs(size, chunk_size) VALUES(0, ?)", [self.chunk_size])
+        blob_id = self.con.lastrowid
+
+        hash = hashlib.sha256()
+        size = 0
+        seq = 0
+        codec = None
+
+        while True:
+            chunk = read_chunk(data, self.chunk_size)
+            if not chunk:
+                break
+
+            if not codec:
+                codec = self.choose_codec(chunk)
+
+            hash.update(chunk)
+            size += len(chunk)
+
+            self.con.execute(
+                "INSERT INTO blob_chunks(blob, seq, data, codec) VALUES(?, ?, ?, ?)",
+                [blob_id, seq, codecs[codec][0](chunk), codec],
+            )
+            seq += 1
+
+        # We only know the hash at the end. If it turns out we already had it, drop the copy
+        blob = self.find_blob(hash.hexdigest())
+        if blob:
+            self.con.execute("DELETE FROM blob_chunks WHERE blob = ?", [blob_id])
+            self.con.execute("DELETE FROM blobs WHERE id = ?", [blob_id])
+            return blob
+
+        self.con.execute(
+            "UPDATE blobs SET hash = ?, size = ?, codec = ? WHERE id = ?",
+            [hash.hexdigest(), size, codec or "raw", blob_id],
+        )
+
+        return blob_id, size
+
+    # Compresses a blob that was stored before compression existed, if it's worth it
+    def compress(self, blob_id):
+        first = self.con.execute(
+            "SELECT data FROM blob_chunks WHERE blob = ? AND seq = 0", [blob_id]
+        ).fetchone()
+
+        codec = self.choose_codec(first[0] if first else b"")
+
+        if codec != "raw":
+            compress = codecs[codec][0]
+
+            for (seq,) in self.con.execute(
+                "SELECT seq FROM blob_chunks WHERE blob = ? ORDER BY seq", [blob_id]
+            ).fetchall():
+                (data,) = self.con.execute(
+                    "SELECT data FROM blob_chunks WHERE blob = ? AND seq = ?", [blob_id, seq]
+                ).fetchone()
+
+                self.con.execute(
+                    "UPDATE blob_chunks SET data = ?, codec = ? WHERE blob = ? AND seq = ?",
+                    [compress(data), codec, blob_id, seq],
+                )
+
+        self.con.execute("UPDATE blobs SET codec = ? WHERE id = ?", [codec, blob_id])
+
+        return codec
+
+    # Returns the id of the file with this name and content, creating it if it's new
+    def link(self, name, blob_id, size):
+        row = self.con.execute(
+            "SELECT id FROM files WHERE blob = ? AND name = ?", [blob_id, name]
+        ).fetchone()
+
+        if row:
+            return row[0]
 
         self.con.execute(
             """
-            INSERT INTO files(name, size, data) VALUES(?, ?, ?)
+            INSERT INTO files(name, size, blob) VALUES(?, ?, ?)
             """,
-            [name, size, data],
+            [name, size, blob_id],
         )
+        id = self.con.lastrowid
 
-        return self.con.lastrowid
+        self.con.execute("UPDATE blobs SET refs = refs + 1 WHERE id = ?", [blob_id])
+
+        return id
+
+    def pack(self, value):
+        if not value:
+            return None
+
+        name, data, *sha256 = value
+        assert isinstance(name, str)
+        assert isinstance(data, bytes) or hasattr(data, "read")
+
+        return self.link(name, *self.store(data, *sha256))
 
+    # Returns the file name and a file handle to read its content
     def unpack(self, id):
         if not id:
             return None
 
-        (name, data) = self.con.execute(
-            """
-            SELECT name, data FROM files WHERE id = ?
-            """,
-            [id],
-        ).fetchone()
+        with self.reader() as con:
+            (name, blob_id, size, chunk_size) = con.execute(
+                """
+                SELECT files.name, blobs.id, blobs.size, blobs.chunk_size
+                    FROM files JOIN blobs ON blobs.id = files.blob
+                    WHERE files.id = ?
+                """,
+                [id],
+            ).fetchone()
 
-        return name, data
+        return name, BlobFile(self.reader, blob_id, size, chunk_size)
 
     def match(self, value, pattern):
         id = value
@@ -131,55 +622,107 @@ class Files:
         if not id:
             return False
 
-        (name,) = self.con.execute(
-            """
-            SELECT name FROM files WHERE id = ?
-            """,
-            [id],
-        ).fetchone()
+        with self.reader() as con:
+            (name,) = con.execute(
+                """
+                SELECT name FROM files WHERE id = ?
+                """,
+                [id],
+            ).fetchone()
 
         return pattern in name
 
+    # SQL counterpart of match, looks for the pattern in the entry's file name
+    def where(self, pattern):
+        return (
+            "EXISTS (SELECT 1 FROM files WHERE files.id = entries.file AND instr(files.name, ?) > 0)",
+            [pattern],
+        )
+
+
+def is_url(link):
+    return validators.url(link, public=True) == True
+
+
+# Validating a link is slow and the same links come up again and again, so the last few thousand
+# results are kept
+@functools.lru_cache(maxsize=4096)
+def complete_link(link):
+    # Links without a scheme never validate as they are. Others can still have "://" further
+    # along, like example.com/r?to=https://foo.com
+    if re.match(r"[a-zA-Z][\w+.-]*://", link):
+        assert is_url(link), "Not a valid link"
+        return link
+
+    for prefix in [
+        "https://",
+        "https://www.",
+    ]:
+        if is_url(prefix + link):
+            return prefix + link
+
+    assert False, "Not a valid link"
+
+
+# Canonical form of a complete link, the same for every way of writing it: no scheme, no "www.",
+# no default port, no fragment and no trailing slash, with the host in lower case
+@functools.lru_cache(maxsize=4096)
+def link_key(link):
+    parts = urllib.parse.urlsplit(link)
+    host = (parts.hostname or "").lower()
+
+    if host.startswith("www."):
+        host = host[4:]
+
+    if parts.port and parts.port not in [80, 443]:
+        host += ":%d" % parts.port
+
+    key = host + parts.path.rstrip("/")
+
+    if parts.query:
+        key += "?" + parts.query
+
+    return key
+
 
 class Link:
     def __init__(self):
         pass
 
     def is_url(self, link):
-        return validators.url(link, public=True) == True
+        return is_url(link)
 
     def complete_link(self, link):
-
-        if self.is_url(link):
-            return link
-
-        for prefix in [
-            "https://",
-            "https://www.",
-        ]:
-            if self.is_url(prefix + link):
-                return prefix + link
-
-        assert False, "Not a valid link"
+        return complete_link(link)
 
     def pack(self, value):
         if not value:
             return value
 
-        # TODO check if link already exists
-
         return self.complete_link(value)
 
+    # Key used to find other entries with the same link, given a packed link
+    def key(self, value):
+        if not value:
+            return None
+
+        return link_key(value)
+
     def unpack(self, value):
         return value
 
     def match(self, value, pattern):
         return value and pattern in value
 
+    # SQL counterpart of match
+    def where(self, pattern):
+        return "instr(entries.link, ?) > 0", [pattern]
+
 
 class Notes:
-    def __init__(self, connection):
+    def __init__(self, connection, reader):
         self.con = connection
+        self.reader = reader
 
         self.con.execute(
             """
@@ -191,13 +734,21 @@ class Notes:
             """
         )
 
-    def next_block_id(self):
-        (id,) = self.con.execute("SELECT MAX(block_id) FROM notes").fetchone()
+        self.con.execute("CREATE INDEX IF NOT EXISTS notes_block ON notes(block_id)")
 
-        if not id:
-            return 1
+        # Sequence of block ids. Taking one is a single insert, which is safe across connections
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS note_blocks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT
+            )
+            """
+        )
+
+    def next_block_id(self):
+        self.con.execute("INSERT INTO note_blocks DEFAULT VALUES")
 
-        return id + 1
+        return self.con.lastrowid
 
     def pack(self, value):
         if not value:
@@ -207,20 +758,22 @@ class Notes:
 
         for note in value:
             assert isinstance(note, str)
-            self.con.execute(
-                """
-                INSERT INTO notes(block_id, note) VALUES(?, ?)
-                """, [id, note]
-            )
+
+        self.con.executemany(
+            """
+            INSERT INTO notes(block_id, note) VALUES(?, ?)
+            """, [(id, note) for note in value]
+        )
 
         return id
 
     def unpack(self, value):
-        return self.con.execute(
-            """
-            SELECT id, note FROM notes WHERE block_id = ?
-            """, [value]
-        ).fetchall()
+        with self.reader() as con:
+            return con.execute(
+                """
+                SELECT id, note FROM notes WHERE block_id = ?
+                """, [value]
+            ).fetchall()
 
     # TODO add support for editing notes
     def update(self, _old, dif):
@@ -229,19 +782,164 @@ class Notes:
     def match(self, value, pattern):
         return value and pattern in value
 
+    # Looks for the pattern in the text of the entry's notes
+    def where(self, pattern):
+        return (
+            "EXISTS (SELECT 1 FROM notes WHERE notes.block_id = entries.notes AND instr(notes.note, ?) > 0)",
+            [pattern],
+        )
+
+
+# Full text index over the name, link, file name and notes of every visible entry. Uses the trigram
+# tokenizer, so that a MATCH finds any substring of at least 3 characters, just like `in` would
+class FullText:
+    def __init__(self, connection):
+        self.con = connection
+
+        try:
+            self.con.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+                    name, link, file, notes,
+                    tokenize = "trigram case_sensitive 1"
+                )
+                """
+            )
+            self.available = True
+
+        # SQLite was built without FTS5 or is too old for the trigram tokenizer
+        except sqlite3.OperationalError:
+            self.available = False
+
+    # Indexes a single entry, a range of them, or every visible entry when no id is given
+    def index(self, entry_id=None, last_id=None):
+        if not self.available:
+            return
+
+        if entry_id and last_id:
+            where, params = "entries.id BETWEEN ? AND ? AND entries.hidden = 0", [entry_id, last_id]
+        elif entry_id:
+            where, params = "entries.id = ?", [entry_id]
+        else:
+            where, params = "entries.hidden = 0", []
+
+        self.con.execute(
+            """
+            INSERT INTO entries_fts(rowid, name, link, file, notes)
+            SELECT entries.id, entries.name, entries.link, files.name, (
+                SELECT group_concat(note, ' ') FROM notes WHERE notes.block_id = entries.notes
+            )
+            FROM entries LEFT JOIN files ON files.id = entries.file
+            WHERE %s
+            """
+            % where,
+            params,
+        )
+
+    def unindex(self, entry_id):
+        if self.available:
+            self.con.execute("DELETE FROM entries_fts WHERE rowid = ?", [entry_id])
+
+    # Patterns shorter than a trigram can't be looked up in the index
+    def can_match(self, pattern):
+        return self.available and len(pattern) >= 3
+
+    # Quotes the pattern as a single FTS5 phrase, which the trigram tokenizer turns into a substring
+    # search
+    def phrase(self, pattern):
+        return '"%s"' % pattern.replace('"', '""')
+
+
+# Converts a time search option into a unix timestamp. Accepts timestamps, ISO dates like
+# "2020-05-01" and durations back from now like "30m", "12h", "7d" or "2w"
+def parse_time(value, now=None):
+    if isinstance(value, list):
+        assert len(value) == 1, "Expected a single time value"
+        value = value[0]
+
+    if isinstance(value, (int, float)):
+        return value
+
+    assert isinstance(value, str), "Not a valid time: %s" % value
+
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+    if value[:-1].isdigit() and value[-1] in units:
+        return (now or time.time()) - int(value[:-1]) * units[value[-1]]
+
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        assert False, "Not a valid time: %s" % value
+
 
 def scrub(table_name):
     return "".join(chr for chr in table_name if chr.isalnum() or chr in ["_"])
 
 
+# A single result row. Values are kept as they come from the database, and each one is only unpacked
+# the first time it is read
+class Row:
+    __slots__ = ["keys", "values", "unpackf", "cache"]
+
+    missing = object()
+
+    def __init__(self, keys, values, unpackf):
+        self.keys = keys
+        self.values = values
+        self.unpackf = unpackf
+        self.cache = [Row.missing] * len(keys)
+
+    def __getitem__(self, key):
+        i = key if isinstance(key, int) else self.keys.index(key)
+
+        if self.cache[i] is Row.missing:
+            self.cache[i] = self.unpackf[self.keys[i]](self.values[i])
+
+        return self.cache[i]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.keys)))
+
+    def __repr__(self):
+        return "Row(%s)" % ", ".join("%s=%r" % (k, v) for k, v in zip(self.keys, self.values))
+
+
 class Archive:
-    def __init__(self, db_file):
+    # Settings for every connection. Negative cache sizes are in KiB
+    pragmas = {
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+    }
+
+    def __init__(self, db_file, readers=4, tracer=None):
         print("init")
 
-        # Create a connection to the database
-        self.db = sqlite3.connect(db_file)
+        self.db_file = db_file
+
+        # Optional sqltrace.Tracer that times every statement run on the archive's connections
+        self.tracer = tracer
+
+        # Writes go through a single connection, one transaction at a time. Connections can be used
+        # by any thread, file handles returned by get are read by the ones discord uploads them from
+        self.db = self.connect()
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
         self.con = self.db.cursor()
 
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.owner = None
+
+        # Idle read only connections. In memory databases can't be shared, so they read from the
+        # writer instead
+        if db_file in [":memory:", ""]:
+            self.readers = None
+        else:
+            self.readers = queue.Queue(readers)
+
         # Initialize all required tables
         self.con.execute(
             """
@@ -255,18 +953,42 @@ class Archive:
                 link TEXT,                              -- 
                 file INTEGER,                           -- 
                 notes INTEGER,                          -- 
+                link_key TEXT,                          -- link in canonical form
                 FOREIGN KEY(file) REFERENCES files(id)
                 FOREIGN KEY(notes) REFERENCES notes(block_id)
             )
             """
         )
 
+        # Visible entries sorted by creation time and name, for time ranges and ordered finds
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS entries_ctime ON entries(ctime, id) WHERE hidden = 0"
+        )
+        self.con.execute(
+            """
+            CREATE INDEX IF NOT EXISTS entries_name ON entries(IFNULL(name, ''), id)
+                WHERE hidden = 0
+            """
+        )
+
+        # Visible entries with every column find can return, so that listing them never touches
+        # the table itself nor the hidden rows. hidden is included, or SQLite wouldn't consider the
+        # index covering
+        self.con.execute(
+            """
+            CREATE INDEX IF NOT EXISTS entries_visible
+                ON entries(id, name, ctime, tags, link, file, notes, hidden)
+                WHERE hidden = 0
+            """
+        )
+
         identity = lambda value: value
 
-        self.files = Files(self.db.cursor())
-        self.tags = Tags()
+        self.files = Files(self.db.cursor(), self.reader)
+        self.tags = Tags(self.db.cursor())
         self.link = Link()
-        self.notes = Notes(self.db.cursor())
+        self.notes = Notes(self.db.cursor(), self.reader)
+        self.text = FullText(self.db.cursor())
         self.unpackf = {
             "id": identity,
             "name": identity,
@@ -279,6 +1001,73 @@ class Archive:
             "notes": self.notes.unpack
         }
 
+        self.migrate()
+
+    # Opens a new connection to the database, with the settings every connection uses
+    def connect(self, readonly=False):
+        factory = sqltrace.TracingConnection if self.tracer else sqlite3.Connection
+
+        if readonly:
+            path = urllib.request.pathname2url(os.path.abspath(self.db_file))
+            con = sqlite3.connect(
+                "file:%s?mode=ro" % path, uri=True, check_same_thread=False, factory=factory
+            )
+        else:
+            con = sqlite3.connect(self.db_file, check_same_thread=False, factory=factory)
+
+        if self.tracer:
+            con.tracer = self.tracer
+
+        metrics.registry.watch(con)
+
+        for pragma, value in self.pragmas.items():
+            con.execute("PRAGMA %s = %d" % (pragma, value))
+
+        return con
+
+    def close(self):
+        while self.readers and not self.readers.empty():
+            self.readers.get_nowait().close()
+
+        self.db.close()
+
+    # Lends a connection to read from. Reads use the pool of read only connections, so they neither
+    # wait for nor block writes. The exception is a thread in the middle of a transaction, which
+    # must see its own changes
+    @contextlib.contextmanager
+    def reader(self):
+        if self.readers is None or self.owner == threading.get_ident():
+            with self.lock:
+                yield self.db
+
+            return
+
+        try:
+            con = self.readers.get_nowait()
+        except queue.Empty:
+            con = self.connect(readonly=True)
+
+        try:
+            yield con
+        finally:
+            try:
+                self.readers.put_nowait(con)
+            except queue.Full:
+                con.close()
+
+    # Schema changes and backfills, applied in order. The database's user_version holds how many of
+    # them have already been applied
+    def migrate(self):
+        (version,) = self.con.execute("PRAGMA user_version").fetchone()
+
+        for version, migration in enumerate(self.migrations[version:], version + 1):
+            print("migrate", migration.__name__)
+
+            migration(self)
+            self.con.execute("PRAGMA user_version = %d" % version)
+
+        self.db.commit()
+
     def unpack(self, keys, values):
         return tuple(self.unpackf[key](value) for key, value in zip(keys, values))
 
@@ -291,10 +1080,37 @@ class Archive:
 
         return keys
 
-    # Adds a brand new item to the archive
-    def add(self, name=None, link=None, file=None, tags=None, notes=None):
-        # print("add", fields)
-
+    # Groups every change made inside it under a single commit, or none at all if something fails.
+    # Scopes can be nested, only the outermost one commits
+    @contextlib.contextmanager
+    def transaction(self):
+        # Other threads wait here until the transaction is over
+        with self.lock:
+            self.depth += 1
+            self.owner = threading.get_ident()
+
+            try:
+                yield self
+            except BaseException:
+                self.depth -= 1
+                if not self.depth:
+                    self.owner = None
+                    self.db.rollback()
+
+                raise
+
+            self.depth -= 1
+            self.commit()
+
+    # Commits pending changes, unless they belong to a transaction scope
+    def commit(self):
+        with self.lock:
+            if not self.depth:
+                self.owner = None
+                self.db.commit()
+
+    # Packs the fields of a new entry into the values of its row, except the id
+    def prepare_entry(self, name=None, link=None, file=None, tags=None, notes=None):
         tags = self.tags.pack(tags)
         link = self.link.pack(link)
         file_id = self.files.pack(file)
@@ -304,118 +1120,231 @@ class Archive:
         if not name and file_id:
             name = file[0]
 
-        self.con.execute(
-            """
-            INSERT INTO entries(name, ctime, tags, link, file, notes) VALUES(?, ?, ?, ?, ?, ?)
-            """,
-            [name, ctime, tags, link, file_id, notes_id],
-        )
+        return [name, ctime, tags, link, file_id, notes_id, self.link.key(link)]
 
-        self.db.commit()
-        return self.con.lastrowid
+    # Adds a brand new item to the archive
+    @metrics.timed("archive")
+    def add(self, name=None, link=None, file=None, tags=None, notes=None):
+        # print("add", fields)
+
+        with self.transaction():
+            values = self.prepare_entry(name, link, file, tags, notes)
+
+            self.con.execute(
+                """
+                INSERT INTO entries(name, ctime, tags, link, file, notes, link_key)
+                    VALUES(?, ?, ?, ?, ?, ?, ?)
+                """,
+                values,
+            )
+
+            id = self.con.lastrowid
+            self.tags.index(id, values[2])
+            self.text.index(id)
+
+        return id
+
+    # Adds many new items at once, each given as a dict of the arguments to add. Everything is
+    # written in a single transaction. Returns the ids of the new entries, in the same order
+    @metrics.timed("archive")
+    def add_many(self, entries):
+        with self.transaction():
+            # Hold the write lock from the start, the ids we pick must stay free
+            if not self.db.in_transaction:
+                self.con.execute("BEGIN IMMEDIATE")
+
+            (last_id,) = self.con.execute(
+                """
+                SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'entries'), 0),
+                           IFNULL((SELECT MAX(id) FROM entries), 0))
+                """
+            ).fetchone()
+
+            rows = [
+                [id, *self.prepare_entry(**fields)]
+                for id, fields in enumerate(entries, last_id + 1)
+            ]
+
+            if not rows:
+                return []
+
+            self.con.executemany(
+                """
+                INSERT INTO entries(id, name, ctime, tags, link, file, notes, link_key)
+                    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+
+            self.tags.index_many((row[0], row[3]) for row in rows)
+            self.text.index(rows[0][0], rows[-1][0])
+
+        return [row[0] for row in rows]
 
     # Deletes an item from the archive. The item is still kept, but it won't be visible
+    @metrics.timed("archive")
     def delete(self, id, dont_commit=False):
         print("delete", id)
 
-        self.con.execute(
-            """
-            UPDATE entries
-            SET hidden = 1
-            WHERE id = ?
-            """,
-            [id],
-        )
+        with self.lock:
+            self.con.execute(
+                """
+                UPDATE entries
+                SET hidden = 1
+                WHERE id = ?
+                """,
+                [id],
+            )
 
-        if not dont_commit:
-            self.db.commit()
+            self.tags.unindex(id)
+            self.text.unindex(id)
+
+            if not dont_commit:
+                self.commit()
 
     # Updates an item in the archive. Changes are made by inserting a new entry and hidding the old
     # one, but nothing ever gets deleted
+    @metrics.timed("archive")
     def update(self, id, changed):
         print("update", changed)
 
-        updateable = ["name", "tags", "link", "notes"]
-        old_values = self.con.execute(
-            """
-            SELECT %s FROM entries WHERE id = ?
-            """
-            % ", ".join(updateable),
-            [id],
-        ).fetchone()
+        with self.transaction():
+            updateable = ["name", "tags", "link", "notes"]
+            old_values = self.con.execute(
+                """
+                SELECT %s FROM entries WHERE id = ?
+                """
+                % ", ".join(updateable),
+                [id],
+            ).fetchone()
 
-        if not old_values:
-            raise IDNotFound("Entry with id(%s) must exist" % id)
+            if not old_values:
+                raise IDNotFound("Entry with id(%s) must exist" % id)
 
-        old = dict(zip(updateable, old_values))
+            old = dict(zip(updateable, old_values))
 
-        fields = ["id", "name", "tags", "link", "notes"]
-        parameters = []
+            fields = ["id", "name", "tags", "link", "notes", "ctime", "link_key", "file"]
+            parameters = []
 
-        if "name" in changed:
-            fields[1] = "?"
-            parameters.append(changed["name"][0])
+            if "name" in changed:
+                fields[1] = "?"
+                parameters.append(changed["name"][0])
 
-        if "tags" in changed:
-            fields[2] = "?"
-            parameters.append(self.tags.update(old["tags"], changed["tags"]))
+            tags = old["tags"]
+            if "tags" in changed:
+                fields[2] = "?"
+                tags = self.tags.update(old["tags"], changed["tags"])
+                parameters.append(tags)
 
-        if "link" in changed:
-            fields[3] = "?"
-            parameters.append(self.link.pack(changed["link"][0]))
+            if "link" in changed:
+                fields[3] = "?"
+                link = self.link.pack(changed["link"][0])
+                parameters.append(link)
 
-        if "notes" in changed:
-            fields[4] = "?"
-            parameters.append(self.notes.update(old["notes"], changed["notes"]))
+            if "notes" in changed:
+                fields[4] = "?"
+                parameters.append(self.notes.update(old["notes"], changed["notes"]))
 
-        # Used at the end by the WHERE clause
-        parameters.append(id)
+            if "link" in changed:
+                fields[6] = "?"
+                parameters.append(self.link.key(link))
 
-        self.con.execute(
-            """
-            INSERT INTO entries(updates, name, tags, link, notes) 
-            SELECT %s
-                FROM entries 
-                WHERE id = ?
-            """
-            % " ,".join(fields),
-            parameters,
-        )
+            # Used at the end by the WHERE clause
+            parameters.append(id)
+
+            self.con.execute(
+                """
+                INSERT INTO entries(updates, name, tags, link, notes, ctime, link_key, file)
+                SELECT %s
+                    FROM entries 
+                    WHERE id = ?
+                """
+                % " ,".join(fields),
+                parameters,
+            )
 
-        new_id = self.con.lastrowid
+            new_id = self.con.lastrowid
 
-        self.delete(id, True)
+            self.delete(id, True)
+            self.tags.index(new_id, tags)
+            self.text.index(new_id)
 
-        self.db.commit()
         return new_id
 
     # Retrieves a single entry, if it exists
+    @metrics.timed("archive")
     def get(self, id, opts=None):
         print("get", id, opts)
 
         opts = self.prepare_get(opts, ["id", "name", "tags", "link", "file", "notes"])
 
-        query = self.con.execute(
-            """
-            SELECT %s FROM entries WHERE id = ?
-            """
-            % ", ".join(opts),
-            [id],
-        ).fetchone()
+        with self.reader() as con:
+            query = con.execute(
+                """
+                SELECT %s FROM entries WHERE id = ?
+                """
+                % ", ".join(opts),
+                [id],
+            ).fetchone()
 
         if not query:
             return None
 
+        metrics.registry.add_rows(1)
+
         return self.unpack(opts, query)
 
+    # Finds the visible entry that already has the same link, written in any form. Returns its id, or
+    # None if there's none
+    def find_link(self, link):
+        key = self.link.key(self.link.pack(link))
+
+        with self.reader() as con:
+            row = con.execute(
+                "SELECT id FROM entries WHERE link_key = ? AND hidden = 0 ORDER BY id LIMIT 1",
+                [key],
+            ).fetchone()
+
+        return row and row[0]
+
+    # Counts how many visible entries have each value of a named tag, like every author:x. Without
+    # a key, lists every key with how many values it has and how many entries have one. Most common
+    # first. Reads the precomputed counts, so it costs the same no matter how big the archive is
+    def facets(self, key=None, limit=None):
+        if key is None:
+            sql = """
+                SELECT key, COUNT(*), SUM(count) FROM tag_counts
+                    WHERE key IS NOT NULL
+                    GROUP BY key
+                    ORDER BY SUM(count) DESC, key
+                """
+            params = []
+        else:
+            sql = """
+                SELECT value, count FROM tag_counts
+                    WHERE key = ?
+                    ORDER BY count DESC, value
+                """
+            params = [key]
+
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self.reader() as con:
+            return con.execute(sql, params).fetchall()
+
     # Checks if all entry's properties match their respective search options
     def __match(self, entry, search_opts):
         for opt in search_opts:
-            assert opt in ["tags", "link", "keyword", "name", "page"], "Cannot search for %s" % opt
+            assert opt in ["tags", "link", "keyword", "name", "page", "numbers"], "Cannot search for %s" % opt
 
             if opt == "tags" and not self.tags.match(entry["tags"], search_opts[opt]):
                 return False
 
+            if opt == "numbers" and not self.tags.compare(entry["tags"], search_opts[opt]):
+                return False
+
             if opt == "link" and not self.link.match(entry["link"], search_opts[opt]):
                 return False
 
@@ -447,36 +1376,475 @@ class Archive:
 
         return False
 
+    # The bot sends the values of options as lists, like ["foo"] for name: foo. Text options take a
+    # single value
+    def prepare_search(self, search_opts):
+        search_opts = dict(search_opts)
+
+        for opt in ["name", "link"]:
+            if opt not in search_opts:
+                continue
+
+            value = search_opts[opt]
+            assert not isinstance(value, dict), "Cannot add or remove values of %s" % opt
+
+            if isinstance(value, list):
+                assert len(value) == 1, "Expected a single value for %s" % opt
+                value = value[0]
+
+            search_opts[opt] = str(value)
+
+        return search_opts
+
+    # Builds the query for find. Each search option becomes a parameterized WHERE clause, so that
+    # SQLite does the filtering and we only ever see the rows that match
+    def plan_find(self, search_opts, columns, order=None, cursor=None):
+        query = Query("entries", ["entries.%s" % column for column in columns])
+        query.where("hidden = 0")
+        ranked = False
+
+        search_opts = self.prepare_search(search_opts)
+
+        for opt, pattern in search_opts.items():
+            assert opt in [
+                "tags", "link", "keyword", "name", "page", "since", "until", "numbers"
+            ], "Cannot search for %s" % opt
+
+            if opt == "tags":
+                query.where(*self.tags.where(pattern))
+
+            if opt == "numbers":
+                query.where(*self.tags.compare_where(pattern))
+
+            if opt == "link":
+                query.where(*self.link.where(pattern))
+
+            if opt == "name":
+                query.where("instr(IFNULL(entries.name, ''), ?) > 0", [pattern])
+
+            if opt == "keyword" and self.text.can_match(str(pattern)):
+                query.join("JOIN entries_fts ON entries_fts.rowid = entries.id")
+                query.where("entries_fts MATCH ?", [self.text.phrase(str(pattern))])
+                ranked = True
+
+            elif opt == "keyword":
+                clauses = [
+                    self.link.where(pattern),
+                    ("instr(IFNULL(entries.name, ''), ?) > 0", [pattern]),
+                    self.files.where(pattern),
+                    self.notes.where(pattern),
+                ]
+
+                query.where(
+                    " OR ".join(clause for clause, _ in clauses),
+                    [p for _, params in clauses for p in params],
+                )
+
+            if opt == "since":
+                query.where("entries.ctime >= ?", [parse_time(pattern)])
+
+            if opt == "until":
+                query.where("entries.ctime < ?", [parse_time(pattern)])
+
+        column, direction = self.prepare_order(order)
+
+        # Any other column is a numeric tag. Entries without it go last
+        if column not in [*self.sortable, "rank"]:
+            assert cursor is None, "Cannot continue from an id when ordering by %s" % column
+
+            value = (
+                "(SELECT %s(value) FROM entry_numbers WHERE key = ? AND entry_id = entries.id)"
+                % ("MAX" if direction == "desc" else "MIN")
+            )
+            query.order_by("%s IS NULL" % value, [column])
+            query.order_by("%s %s" % (value, direction.upper()), [column])
+
+            column = "id"
+
+        if column == "rank":
+            assert cursor is None, "Cannot continue from an id when ordering by rank"
+
+            # Best BM25 matches first, then newest entries
+            if ranked:
+                query.order_by("entries_fts.rank")
+
+            column, direction = "id", "desc"
+
+        sort = self.sortable[column]
+        less = "<" if direction == "desc" else ">"
+
+        # Continue right after the cursor's entry, in the same order
+        if cursor is not None and column == "id":
+            query.where("entries.id %s ?" % less, [cursor])
+
+        elif cursor is not None:
+            query.where(
+                "(%s, entries.id) %s (SELECT %s, id FROM entries AS c WHERE c.id = ?)"
+                % (sort % "entries", less, sort % "c"),
+                [cursor],
+            )
+
+        if column != "id":
+            query.order_by("%s %s" % (sort % "entries", direction.upper()))
+
+        # Ties are always broken by id
+        query.order_by("entries.id %s" % direction.upper())
+
+        return query
+
+    # Expressions that results can be sorted by, for a given table name
+    sortable = {
+        "id": "%s.id",
+        "ctime": "%s.ctime",
+        "name": "IFNULL(%s.name, '')",
+    }
+
+    # Turns an order option like "name", "ctime asc" or ["ctime", "desc"] into a column and a
+    # direction. The default is newest entries first
+    def prepare_order(self, order):
+        if not order:
+            return "id", "desc"
+
+        if isinstance(order, str):
+            order = order.split()
+
+        assert isinstance(order, list) and 1 <= len(order) <= 2, "Order must be a column and a direction"
+
+        column = order[0]
+        # Besides the sortable columns, entries can be sorted by a numeric tag. Only keys with some
+        # numeric value are taken, so a typo is an error rather than the default order
+        assert column in [*self.sortable, "rank"] or (
+            isinstance(column, str)
+            and re.fullmatch(r"\w+", column)
+            and column not in self.unpackf
+            and self.is_number_key(column)
+        ), "Cannot order by %s" % column
+
+        direction = order[1] if len(order) > 1 else ("asc" if column == "name" else "desc")
+        assert direction in ["asc", "desc"], "Order direction must be asc or desc"
+
+        return column, direction
+
+    # Whether some visible entry has a numeric tag with this key
+    def is_number_key(self, key):
+        with self.reader() as con:
+            row = con.execute("SELECT 1 FROM entry_numbers WHERE key = ? LIMIT 1", [key]).fetchone()
+
+        return row is not None
+
+    # Builds the query for a find and returns its SQL, parameters and the columns it returns
+    def prepare_find(self, search_opts, result_opts, order, cursor, limit, offset):
+        page = search_opts.get("page", [0])[0]
+        assert isinstance(page, int)
+        assert cursor is None or isinstance(cursor, int), "Can only continue after an entry id"
+
+        result_opts = self.prepare_get(
+            result_opts, ["id", "name", "ctime", "tags", "link", "file", "notes"]
+        )
+
+        query = self.plan_find(search_opts, result_opts, order, cursor)
+        sql, params = query.paginate(limit, offset).build()
+
+        return sql, params, tuple(result_opts)
+
+    # Streams the entries that match the required parameters, one row at a time. Nothing is
+    # unpacked until the caller reads that column from the row
+    def iter_find(self, search_opts, result_opts=None, order=None, cursor=None, limit=None, offset=0):
+        sql, params, keys = self.prepare_find(
+            search_opts, result_opts, order, cursor, limit, offset
+        )
+
+        # Use a cursor of our own, so that other queries don't interrupt the stream
+        with self.reader() as con:
+            for values in con.execute(sql, params):
+                metrics.registry.add_rows(1)
+                yield Row(keys, values, self.unpackf)
+
+    # Same as iter_find, but reads every row at once into a ResultSet
+    def find_results(self, search_opts, result_opts=None, order=None, cursor=None, limit=None, offset=0):
+        sql, params, keys = self.prepare_find(
+            search_opts, result_opts, order, cursor, limit, offset
+        )
+
+        with self.reader() as con:
+            rows = con.execute(sql, params).fetchall()
+
+        metrics.registry.add_rows(len(rows))
+
+        return ResultSet.from_rows(keys, rows, [self.unpackf[key] for key in keys])
+
     # Retrieves entries that match the required parameters
-    def find(self, search_opts, result_opts=None):
+    @metrics.timed("archive")
+    def find(self, search_opts, result_opts=None, order=None):
         print("find", search_opts, result_opts)
 
+        result_opts = self.prepare_get(result_opts, ["id", "name", "tags", "link"])
+
+        return self.find_results(search_opts, result_opts, order)
+
+    # Retrieves a single page of the entries that match the required parameters, newest first unless
+    # another order is given. The page starts right after the cursor (the last id seen), or skips
+    # offset entries. Also tells whether there are more entries after this page
+    @metrics.timed("archive")
+    def find_page(self, search_opts, result_opts=None, page_size=10, cursor=None, offset=0, order=None):
+        print("find_page", search_opts, result_opts, cursor, offset)
+
+        result_opts = self.prepare_get(result_opts, ["id", "name", "tags", "link"])
+
+        # Ask for one extra row to know if there's another page
+        results = self.find_results(
+            search_opts, result_opts, order, cursor, limit=page_size + 1, offset=offset
+        )
+
+        return results[:page_size], len(results) > page_size
+
+    # Counts the entries that match the required parameters, without retrieving them
+    @metrics.timed("archive")
+    def count(self, search_opts):
+        query = self.plan_find(search_opts, [])
+        query.columns = ["COUNT(*)"]
+        query.order = []
+
+        sql, params = query.build()
+        with self.reader() as con:
+            (count,) = con.execute(sql, params).fetchone()
+
+        return count
+
+    # Reference implementation of find, which scans every visible entry and filters them in
+    # Python. Kept around to check and benchmark the query planner against
+    def find_scan(self, search_opts, result_opts=None):
         page = search_opts.get("page", [0])[0]
         assert isinstance(page, int)
 
+        search_opts = self.prepare_search(search_opts)
+
         result_opts = self.prepare_get(result_opts, ["id", "name", "tags", "link"])
 
         result = []
 
-        for (id, name, tags, link, file, notes) in self.con.execute(
-            "SELECT id, name, tags, link, file, notes FROM entries WHERE hidden = 0"
-        ):
-            entry = {
-                "id": id,
-                "name": name,
-                "tags": self.tags.unpack(tags),
-                "link": self.link.unpack(link),
-                "file": file,
-                "notes": notes
-            }
-
-            if not self.__match(entry, search_opts):
-                continue
+        with self.reader() as con:
+            for (id, name, tags, link, file, notes) in con.execute(
+                "SELECT id, name, tags, link, file, notes FROM entries WHERE hidden = 0 ORDER BY id"
+            ):
+                entry = {
+                    "id": id,
+                    "name": name,
+                    "tags": self.tags.unpack(tags),
+                    "link": self.link.unpack(link),
+                    "file": file,
+                    "notes": notes
+                }
 
-            result.append(tuple(entry[e] for e in result_opts))
+                if not self.__match(entry, search_opts):
+                    continue
+
+                result.append(tuple(entry[e] for e in result_opts))
 
         # Reverse results order
         result = result[::-1]
         return result
 
+    # Compresses files that were stored before compression existed. Commits after every file, so it
+    # can run in the background, bit by bit. Returns how many files were processed
+    def compress_files(self, limit=None):
+        with self.reader() as con:
+            ids = con.execute(
+                "SELECT id FROM blobs WHERE codec IS NULL ORDER BY id LIMIT ?",
+                [-1 if limit is None else limit],
+            ).fetchall()
+
+        for (id,) in ids:
+            with self.transaction():
+                print("compress", id, self.files.compress(id))
+
+        return len(ids)
+
+    def migrate_entry_tags(self):
+        for id, tags in self.con.execute(
+            "SELECT id, tags FROM entries WHERE hidden = 0"
+        ).fetchall():
+            self.tags.index(id, tags)
+
+    def migrate_full_text(self):
+        if self.text.available:
+            self.con.execute("DELETE FROM entries_fts")
+            self.text.index()
+
+    # Updates used to lose the creation time of the entry they replaced
+    def migrate_update_ctime(self):
+        for id, updates in self.con.execute(
+            "SELECT id, updates FROM entries WHERE ctime IS NULL ORDER BY id"
+        ).fetchall():
+            self.con.execute(
+                "UPDATE entries SET ctime = (SELECT ctime FROM entries WHERE id = ?) WHERE id = ?",
+                [updates, id],
+            )
+
+    # Moves the content of every file into blobs, keyed by hash. Files with the same name and content
+    # are merged into one
+    def migrate_file_blobs(self):
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(files)")]
+
+        if not "blob" in columns:
+            self.con.execute("ALTER TABLE files ADD COLUMN blob INTEGER REFERENCES blobs(id)")
+
+        if "data" in columns:
+            for (id,) in self.con.execute(
+                "SELECT id FROM files WHERE data IS NOT NULL ORDER BY id"
+            ).fetchall():
+                # One file at a time, they might be big
+                (name, data) = self.con.execute(
+                    "SELECT name, data FROM files WHERE id = ?", [id]
+                ).fetchone()
+
+                blob_id, _size = self.files.store(data)
+                kept = self.con.execute(
+                    "SELECT id FROM files WHERE blob = ? AND name = ?", [blob_id, name]
+                ).fetchone()
+
+                if kept:
+                    self.con.execute("DELETE FROM files WHERE id = ?", [id])
+                    self.con.execute("UPDATE entries SET file = ? WHERE file = ?", [kept[0], id])
+                else:
+                    self.con.execute(
+                        "UPDATE files SET blob = ?, data = NULL WHERE id = ?", [blob_id, id]
+                    )
+
+            self.con.execute(
+                "UPDATE blobs SET refs = (SELECT COUNT(*) FROM files WHERE files.blob = blobs.id)"
+            )
+
+        self.con.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_blob ON files(blob, name)")
+
+    # Splits blobs that were stored in a single row into chunks
+    def migrate_blob_chunks(self):
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(blobs)")]
+
+        if not "chunk_size" in columns:
+            self.con.execute("ALTER TABLE blobs ADD COLUMN chunk_size INT")
+
+        if "data" in columns:
+            for (id,) in self.con.execute(
+                "SELECT id FROM blobs WHERE data IS NOT NULL ORDER BY id"
+            ).fetchall():
+                (data,) = self.con.execute("SELECT data FROM blobs WHERE id = ?", [id]).fetchone()
+
+                self.con.executemany(
+                    "INSERT INTO blob_chunks(blob, seq, data) VALUES(?, ?, ?)",
+                    [
+                        (id, seq, data[start : start + self.files.chunk_size])
+                        for seq, start in enumerate(range(0, len(data), self.files.chunk_size))
+                    ],
+                )
+
+                self.con.execute(
+                    "UPDATE blobs SET data = NULL, chunk_size = ? WHERE id = ?",
+                    [self.files.chunk_size, id],
+                )
+
+    # Existing blobs are left uncompressed (NULL), compress_files takes care of them
+    def migrate_blob_codec(self):
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(blobs)")]
+
+        if not "codec" in columns:
+            self.con.execute("ALTER TABLE blobs ADD COLUMN codec TEXT")
+
+    # Starts the note block sequence after the blocks that already exist
+    def migrate_note_blocks(self):
+        self.con.execute(
+            """
+            INSERT INTO note_blocks(id)
+                SELECT MAX(block_id) FROM notes WHERE block_id IS NOT NULL HAVING COUNT(*) > 0
+            """
+        )
+
+    # Stores every link in canonical form, and indexes the visible ones to find duplicates
+    def migrate_link_keys(self):
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(entries)")]
+
+        if not "link_key" in columns:
+            self.con.execute("ALTER TABLE entries ADD COLUMN link_key TEXT")
+
+        links = self.con.execute(
+            "SELECT id, link FROM entries WHERE link IS NOT NULL AND link_key IS NULL"
+        ).fetchall()
+
+        self.con.executemany(
+            "UPDATE entries SET link_key = ? WHERE id = ?",
+            [(self.link.key(link), id) for id, link in links],
+        )
+
+        # hidden makes the index covering, like entries_visible
+        self.con.execute(
+            """
+            CREATE INDEX IF NOT EXISTS entries_link_key ON entries(link_key, hidden)
+                WHERE hidden = 0 AND link_key IS NOT NULL
+            """
+        )
+
+    # Counts the tags already in the index
+    def migrate_tag_counts(self):
+        self.con.execute("DELETE FROM tag_counts")
+        self.con.execute(
+            """
+            INSERT INTO tag_counts(tag, key, value, count)
+                SELECT tag, %s, %s, COUNT(*) FROM entry_tags GROUP BY tag
+            """
+            % self.tags.split_sql("tag")
+        )
+
+    # Indexes the numeric tags of visible entries
+    def migrate_entry_numbers(self):
+        for id, tags in self.con.execute(
+            "SELECT id, tags FROM entries WHERE hidden = 0"
+        ).fetchall():
+            self.tags.index(id, tags)
+
+    # Readers decompress each chunk with its own codec. Chunks of blobs compressed so far get the
+    # codec of their blob
+    def migrate_chunk_codec(self):
+        columns = [row[1] for row in self.con.execute("PRAGMA table_info(blob_chunks)")]
+
+        if not "codec" in columns:
+            self.con.execute("ALTER TABLE blob_chunks ADD COLUMN codec TEXT")
+
+        self.con.execute(
+            """
+            UPDATE blob_chunks SET codec = (SELECT codec FROM blobs WHERE blobs.id = blob_chunks.blob)
+                WHERE codec IS NULL
+            """
+        )
+
+    # Updates used to lose the file of the entry they replaced, and the file name went missing from
+    # the full text index with it
+    def migrate_update_file(self):
+        for id, updates, hidden in self.con.execute(
+            "SELECT id, updates, hidden FROM entries WHERE file IS NULL AND updates > 0 ORDER BY id"
+        ).fetchall():
+            self.con.execute(
+                "UPDATE entries SET file = (SELECT file FROM entries WHERE id = ?) WHERE id = ?",
+                [updates, id],
+            )
 
+            # Hidden entries aren't in the index
+            if not hidden and self.con.rowcount and self.con.execute(
+                "SELECT file FROM entries WHERE id = ?", [id]
+            ).fetchone()[0]:
+                self.text.unindex(id)
+                self.text.index(id)
+
+    migrations = [
+        migrate_entry_tags,
+        migrate_full_text,
+        migrate_update_ctime,
+        migrate_file_blobs,
+        migrate_blob_chunks,
+        migrate_blob_codec,
+        migrate_note_blocks,
+        migrate_link_keys,
+        migrate_tag_counts,
+        migrate_entry_numbers,
+        migrate_chunk_codec,
+        migrate_update_file,
+    ]
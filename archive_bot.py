@@ -1,4 +1,7 @@
+import re
 import grammar
+import metrics
+import sqltrace
 
 # Flattens a list by one level
 def flatten(lst):
@@ -52,6 +55,20 @@ def group_args(args):
     return {"add": add, "sub": sub}
 
 
+# Reads the number in a comparison. Numbers with a decimal part arrive as strings
+def parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        assert False, "%s is not a number" % value
+
+
+# Named tags written without a space, like rating:5, are free arguments. The ones that don't name
+# a parameter of the command are tags
+def free_named_tags(args):
+    return [arg for arg in args if isinstance(arg, str) and re.fullmatch(r"\w+:.+", arg)]
+
+
 # Separates 'normal' tags from key:value tags
 def extract_named_tags(tags):
     named_tags = {}
@@ -157,10 +174,29 @@ class ArchiveBot:
             },
             "find": {
                 "usage": "find",
-                "syntax": "!find [keyword] [tags: ...] [page: N]",
-                "examples": ["!find keyword tags: must_have -cannot page: 2"],
+                "syntax": "!find [keyword] [tags: ...] [key: >=N ...] [since: ...] [until: ...] [order: ...] [page: N | after: id]",
+                "examples": [
+                    "!find keyword tags: must_have -cannot page: 2",
+                    "!find tags: must_have after: 123",
+                    "!find tags: proj-* -author:?",
+                    "!find score: >=4 order: score desc",
+                    '!find since: 7d order: ctime asc',
+                    '!find since: "2020-05-01" until: "2020-06-01" order: name',
+                ],
                 "description": "Retrieves a list of entries that match the search parameters.",
             },
+            "facets": {
+                "usage": "facets",
+                "syntax": "!facets [key]",
+                "examples": ["!facets", "!facets author", "!facets added_by"],
+                "description": "Lists every value of a named tag, such as every author, with how many entries have it. Without a key, lists the named tags in use.",
+            },
+            "stats": {
+                "usage": "stats",
+                "syntax": "!stats [command | archive | sql]",
+                "examples": ["!stats", "!stats archive", "!stats sql"],
+                "description": "Shows how many times each command ran, how many failed, how long they took and how much database work they did.",
+            },
             "help": {
                 "usage": "help",
                 "syntax": "!help [command]",
@@ -188,8 +224,9 @@ class ArchiveBot:
 
         if len(args) and not "link" in opts:
             opts["link"] = args[0]
+            args = args[1:]
 
-        tags = ["added_by:%s" % opts["author"][0]]
+        tags = ["added_by:%s" % opts["author"][0], *free_named_tags(args)]
 
         for key, value in opts.items():
             if key == "tags":
@@ -199,8 +236,9 @@ class ArchiveBot:
                 arc_opts[key] = value
 
             elif key == "link":
-                assert isinstance(value[0], str)
-                arc_opts[key] = value
+                link = value if isinstance(value, str) else value[0]
+                assert isinstance(link, str), "Link must be a string."
+                arc_opts[key] = link
 
             elif key == "tags":
                 arc_opts[key] = flatten(args[key])
@@ -231,14 +269,39 @@ class ArchiveBot:
                 "edits": edits,
             }
 
-        id = self.arc.add(**arc_opts)
+        # Entries added by an earlier version of this message are replaced. If the type isn't
+        # 'add', we're probably replacing an error
+        replaced = []
+        if edits and edits["type"] == "add":
+            replaced = edits.get("generated_ids", [edits["generated_id"]])
+
+        # A message with many files adds one entry for each of them. The link and the name go on
+        # the first one only, so the link isn't archived more than once
+        files = arc_opts.pop("file", None)
+        if isinstance(files, list):
+            shared = {k: v for k, v in arc_opts.items() if k not in ["link", "name"]}
+            entries = [{**(shared if i else arc_opts), "file": file} for i, file in enumerate(files)]
+        else:
+            entries = [{**arc_opts, "file": files}]
 
-        result = self.get_resume(id)
-        result["edits"] = {"type": "add", "generated_id": id}
+        with self.arc.transaction():
+            # Checked inside the transaction, so nobody can add the same link in between
+            existing = arc_opts.get("link") and self.arc.find_link(arc_opts["link"])
 
-        # If the type isn't 'add', we're probably replacing an error
-        if edits and edits["type"] == "add":
-            self.arc.delete(edits["generated_id"])
+            if existing and existing not in replaced:
+                return {"error": "Already archived as #%d" % existing, "edits": edits}
+
+            ids = self.arc.add_many(entries)
+
+            for id in replaced:
+                self.arc.delete(id)
+
+        result = self.get_resume(ids[0])
+        result["edits"] = {"type": "add", "generated_id": ids[0]}
+
+        if len(ids) > 1:
+            result["entries"] = ", ".join("#%d" % id for id in ids)
+            result["edits"]["generated_ids"] = ids
 
         return result
 
@@ -268,22 +331,53 @@ class ArchiveBot:
         if args:
             opts["keyword"] = args[0]
         # opts = group_args(opts)
-        result = self.arc.find(opts, fields)
 
-        # Use a small slice as the answer
+        # Comparisons like score: >=4 filter by the value of a numeric tag
+        numbers = []
+        for key, values in list(opts.items()):
+            if isinstance(values, list) and any(isinstance(v, grammar.Compare) for v in values):
+                for value in values:
+                    assert isinstance(value, grammar.Compare), "Expected a comparison for %s" % key
+                    numbers.append((key, value.op, parse_number(value.value)))
+
+                del opts[key]
+
+        if numbers:
+            opts["numbers"] = numbers
+
+        # Either continue after a given id, or go to a page number
         items_per_page = 10
+        cursor = opts.pop("after", [None])[0]
         page = opts.get("page", [1])[0] - 1
-        keys, vals = unpack_tags_column(
-            fields, 
-            result[items_per_page * page : items_per_page * (page + 1)])
 
-        cols = len(keys)
-        dots = ["..."] * cols
+        if cursor is not None:
+            page = 0
+
+        # Keyword searches show the best matches first, unless asked otherwise
+        order = opts.pop("order", None)
+        if not order and "keyword" in opts and cursor is None:
+            order = "rank"
+
+        result, has_more = self.arc.find_page(
+            opts,
+            fields,
+            page_size=items_per_page,
+            cursor=cursor,
+            offset=max(page, 0) * items_per_page,
+            order=order,
+        )
 
-        if page > 0:
-            vals = [dots, *vals]
+        # Named tags get columns of their own, only for the rows on this page
+        result = result.expand("tags", extract_named_tags)
+        keys = list(result.keys)
+        dots = ["..."] * len(keys)
 
-        if len(result) > items_per_page * (page + 1):
+        vals = list(result)
+
+        if page > 0 or cursor is not None:
+            vals.insert(0, dots)
+
+        if has_more:
             vals.append(dots)
 
         return {"table": (vals, keys), "edits": {"type": "find"}}
@@ -298,17 +392,92 @@ class ArchiveBot:
 
         opts = {k: group_args(v) for k, v in opts.items()}
 
-        id = self.arc.update(args[0], opts)
+        named = free_named_tags(args[1:])
+        if named:
+            tags = opts.setdefault("tags", {"add": [], "sub": []})
+            (tags["add"] if isinstance(tags, dict) else tags).extend(named)
+
+        with self.arc.transaction():
+            id = self.arc.update(args[0], opts)
+
+            # If the type isn't 'update', we're probably replacing an error
+            if edits and edits["type"] == "update":
+                self.arc.delete(edits["generated_id"])
 
         result = self.get_resume(id)
         result["edits"] = {"type": "update", "generated_id": id}
 
-        # If the type isn't 'update', we're probably replacing an error
-        if edits and edits["type"] == "update":
-            self.arc.delete(edits["generated_id"])
+        return result
+
+    def facets(self, args, opts, _edits):
+        rows_per_page = 25
+
+        if args:
+            keys = [str(args[0]), "entries"]
+            rows = self.arc.facets(str(args[0]), rows_per_page + 1)
+        else:
+            keys = ["key", "values", "entries"]
+            rows = self.arc.facets(limit=rows_per_page + 1)
+
+        vals = [list(row) for row in rows[:rows_per_page]]
+
+        if len(rows) > rows_per_page:
+            vals.append(["..."] * len(keys))
+
+        return {"table": (vals, keys), "edits": {"type": "facets"}}
+
+    def stats(self, args, opts, _edits):
+        kind = args[0] if args else "command"
+        assert kind in ["command", "archive", "sql"], "Stats are kept for command, archive or sql"
+
+        if kind == "sql":
+            return self.sql_stats()
+
+        keys = ["name", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "sql", "rows", "steps"]
+        vals = []
+
+        for s in metrics.registry.snapshot():
+            if s["kind"] != kind:
+                continue
+
+            # Database work is shown per call
+            count = s["count"] or 1
+            vals.append(
+                [
+                    s["name"],
+                    s["count"],
+                    s["errors"],
+                    *("%.1f" % (s[q] * 1000) for q in ["p50", "p95", "p99"]),
+                    *("%.1f" % (s[key] / count) for key in ["statements", "rows", "steps"]),
+                ]
+            )
+
+        result = {"table": (vals, keys), "edits": {"type": "stats"}}
+
+        for name, values in metrics.registry.read_gauges().items():
+            result[name] = ", ".join("%s %s" % item for item in values.items())
 
         return result
 
+    # Statements that took the most time, when the archive traces them
+    def sql_stats(self):
+        assert self.arc.tracer, "SQL statements are not being traced"
+
+        keys = ["statement", "count", "total ms", "max ms", "slow", "scan"]
+        vals = [
+            [
+                shape.sql if len(shape.sql) <= 80 else shape.sql[:77] + "...",
+                shape.count,
+                "%.1f" % (shape.seconds * 1000),
+                "%.1f" % (shape.max * 1000),
+                shape.slow,
+                "yes" if sqltrace.has_scan(shape.plan) else "",
+            ]
+            for shape in self.arc.tracer.report(10)
+        ]
+
+        return {"table": (vals, keys), "edits": {"type": "stats"}}
+
     def help(self, args, opts, _edits):
         if args:
             return {"usage": self.usage(args[0]), "edits": {"type": "help"}}
@@ -323,15 +492,27 @@ class ArchiveBot:
         other = dict(e for e in args if isinstance(e, tuple))
         opts = {**other, **extra}
 
-        try:
-            commands = {
-                "add": self.add,
-                "get": self.get,
-                "find": self.find,
-                "update": self.update,
-                "help": self.help,
-            }
+        commands = {
+            "add": self.add,
+            "get": self.get,
+            "find": self.find,
+            "update": self.update,
+            "facets": self.facets,
+            "stats": self.stats,
+            "help": self.help,
+        }
+
+        # Any name can be typed, only the real commands get stats of their own
+        with metrics.registry.measure("command", name if name in commands else "unknown") as scope:
+            result = self.run_command(commands, name, free, opts, edits)
+
+            if "error" in result:
+                scope.fail()
 
+        return result
+
+    def run_command(self, commands, name, free, opts, edits):
+        try:
             if name in commands:
                 return commands[name](free, opts, edits)
             else:
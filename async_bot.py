@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import threading
+import metrics
+
+
+class Busy(Exception):
+    pass
+
+
+# A call that didn't finish in time. It keeps running in its thread, and 'future' gets its result
+class TimedOut(Exception):
+    def __init__(self, future):
+        super().__init__()
+        self.future = future
+
+
+# Async front for ArchiveBot. Parsing, database work and link validation all block, so they run in a
+# bounded pool of threads instead of on the discord event loop. Answers are the same dicts
+# ArchiveBot returns
+class AsyncArchiveBot:
+    def __init__(self, bot, workers=4, max_queue=32, timeout=30):
+        self.bot = bot
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, "archive")
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        # Calls that were submitted and haven't finished yet, including the ones that timed out but
+        # are still running in their thread
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+
+        self.counts = {"completed": 0, "timeouts": 0, "rejected": 0, "max_depth": 0}
+        metrics.registry.gauge("pool", self.metrics)
+
+    # Snapshot of how loaded the pool is
+    def metrics(self):
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "running": self.running,
+                "workers": self.workers,
+                **self.counts,
+            }
+
+    def __call(self, fn, args):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.counts["completed"] += 1
+
+    # Runs a blocking function in the pool. Raises Busy if too many calls are waiting already, and
+    # TimedOut if it doesn't finish in time. Threads can't be stopped, so a call that times out
+    # still runs to the end
+    async def run(self, fn, *args, timeout=None):
+        with self.lock:
+            depth = self.queued + self.running
+            if depth >= self.max_queue:
+                self.counts["rejected"] += 1
+                raise Busy()
+
+            self.queued += 1
+            self.counts["max_depth"] = max(self.counts["max_depth"], depth + 1)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, self.__call, fn, args)
+
+        try:
+            # Shielded, so that timing out doesn't cancel the future and it can still be awaited
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.counts["timeouts"] += 1
+
+            raise TimedOut(future)
+
+    async def handle_message(self, message, extra):
+        edits = extra.get("edits", None)
+
+        try:
+            return await self.run(self.bot.handle_message, message, extra)
+
+        except Busy:
+            return {"error": "The archive is busy right now, try again in a moment.", "edits": edits}
+
+        # The answer says the command is still running, and 'pending' gets the real answer
+        except TimedOut as timeout:
+            return {
+                "notice": "The command is taking a while, the answer will show up here once it's done.",
+                "pending": timeout.future,
+                "edits": edits,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
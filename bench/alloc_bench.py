@@ -0,0 +1,71 @@
+# Measures the memory find results take: how many blocks and bytes a result keeps alive, and the
+# peak memory used while building it. Rendering a !find answer into a table is measured too
+#
+# Usage: python -m bench.alloc_bench [entries]
+import contextlib
+import io
+import sys
+import tracemalloc
+
+import archive
+import archive_bot
+import table
+from bench import synthetic
+
+
+# Runs fn and returns its result along with (blocks kept, bytes kept, peak bytes)
+def measure(fn):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+
+    result = fn()
+
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    kept = [s for s in after.compare_to(before, "filename") if s.count_diff > 0]
+    blocks = sum(s.count_diff for s in kept)
+    size = sum(s.size_diff for s in kept)
+
+    return result, (blocks, size, peak)
+
+
+def render(bot, message):
+    answer = bot.handle_message(message, {"author": ["bench"]})
+    rows, keys = answer["table"]
+
+    return table.render(rows, 150, keys)
+
+
+def main(entries=5000):
+    with contextlib.redirect_stdout(io.StringIO()):
+        arc = archive.Archive(":memory:")
+        synthetic.populate(arc, entries)
+
+    bot = archive_bot.ArchiveBot(arc)
+
+    cases = [
+        ("find all", lambda: arc.find({})),
+        ("find tags", lambda: arc.find({"tags": ["tag1"]})),
+        ("find_page", lambda: arc.find_page({}, page_size=10)),
+        ("answer !find", lambda: bot.handle_message("!find", {"author": ["bench"]})),
+        ("render !find", lambda: render(bot, "!find")),
+        ("render !find tags", lambda: render(bot, "!find tags: tag1 page: 2")),
+    ]
+
+    for name, fn in cases:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Once to warm up caches, then measured
+            fn()
+            result, (blocks, size, peak) = measure(fn)
+
+        print(
+            "%-20s kept %7d blocks %9.1fKiB  peak %9.1fKiB"
+            % (name, blocks, size / 1024, peak / 1024)
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
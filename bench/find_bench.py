@@ -0,0 +1,53 @@
+# Compares the query planner in Archive.find against the old full scan in Archive.find_scan
+#
+# Usage: python -m bench.find_bench [entries]
+import random
+import sys
+import timeit
+
+import archive
+
+
+def build_archive(entries, seed=0):
+    rng = random.Random(seed)
+    arc = archive.Archive(":memory:")
+
+    for i in range(entries):
+        tags = ["tag%d" % rng.randrange(100) for _ in range(rng.randrange(1, 6))]
+        tags.append("author:user%d" % rng.randrange(20))
+
+        packed = arc.tags.pack(tags)
+        arc.con.execute(
+            "INSERT INTO entries(name, ctime, tags, link) VALUES(?, ?, ?, ?)",
+            ["entry %d" % i, i, packed, "https://example%d.com/" % i],
+        )
+        arc.tags.index(arc.con.lastrowid, packed)
+        arc.text.index(arc.con.lastrowid)
+
+    arc.db.commit()
+    return arc
+
+
+def main(entries=10000, repeat=5):
+    arc = build_archive(entries)
+
+    for opts in [
+        {"tags": ["tag1"]},
+        {"tags": {"add": ["tag1", "tag2"], "sub": ["tag3"]}},
+        {"name": "entry 99"},
+        {"link": "example42"},
+        {"keyword": "example7"},
+    ]:
+        assert arc.find(opts) == arc.find_scan(opts)
+
+        planned = min(timeit.repeat(lambda: arc.find(opts), number=1, repeat=repeat))
+        scanned = min(timeit.repeat(lambda: arc.find_scan(opts), number=1, repeat=repeat))
+
+        print(
+            "%-55s find %8.2fms  find_scan %8.2fms  x%.1f"
+            % (opts, planned * 1000, scanned * 1000, scanned / planned)
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
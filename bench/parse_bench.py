@@ -0,0 +1,59 @@
+# Compares the LALR command parser against the Earley parser it replaced, both in how long it takes
+# to build the parser and in how many commands per second it parses
+#
+# Usage: python -m bench.parse_bench [rounds]
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+from lark import Lark
+
+import grammar
+
+commands = [
+    "!add link tags: author:slysherz score:1",
+    '!add link tags: [one, two] description: "looks really cool"',
+    "!get 123 [id, name, tags]",
+    '!find "keyword" tags: [one, two, "three"]',
+    "!find keyword [id, tags] tags: +author:? -score:?",
+    "!update 123 tags: +[four, five, seven] -one",
+]
+
+
+# Earley matches terminals as it parses, so it doesn't need (nor accept) terminal priorities
+def earley():
+    with open(grammar.grammar_file, "r") as file:
+        text = re.sub(r"^(\w+)\.\d+:", r"\1:", file.read(), flags=re.M)
+
+    return Lark(text, start="command")
+
+
+def main(rounds=200):
+    with tempfile.TemporaryDirectory() as dir:
+        cache = os.path.join(dir, "grammar.cache")
+        grammar.build_grammar(cache)
+
+        builds = [
+            ("earley", earley),
+            ("lalr", lambda: grammar.build_grammar(None)),
+            ("lalr, cached", lambda: grammar.build_grammar(cache)),
+        ]
+
+        for name, build in builds:
+            elapsed = min(timeit.repeat(build, number=1, repeat=5))
+            print("build %-15s %8.2fms" % (name, elapsed * 1000))
+
+    for name, parser in [("earley", earley()), ("lalr", grammar.build_grammar(None))]:
+        elapsed = min(
+            timeit.repeat(
+                lambda: [parser.parse(c) for c in commands], number=rounds, repeat=3
+            )
+        )
+        count = rounds * len(commands)
+        print("parse %-15s %8.0f commands/s" % (name, count / elapsed))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
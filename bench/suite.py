@@ -0,0 +1,202 @@
+# Times the hot paths of the archive and the bot on generated archives of several sizes, and writes
+# the results as JSON. Giving the results of an earlier run as a baseline prints how much each
+# operation changed since
+#
+# Usage: python -m bench.suite [--sizes 1000,100000,1000000] [--output results.json]
+#                              [--baseline old.json]
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+import archive
+import archive_bot
+from bench import synthetic
+
+
+# Runs 'fn' 'runs' times, calling 'setup' before each run to get its arguments. Only 'fn' is timed
+def measure(fn, runs, setup=lambda: ()):
+    times = []
+
+    for _ in range(runs):
+        args = setup()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+
+    return {
+        "runs": runs,
+        "min_ms": times[0] * 1000,
+        "median_ms": statistics.median(times) * 1000,
+        "mean_ms": statistics.mean(times) * 1000,
+        "p95_ms": times[min(runs - 1, int(runs * 0.95))] * 1000,
+    }
+
+
+# Operations to time on an archive with 'size' entries, as (name, fn, setup)
+def operations(arc, bot, size, rng):
+    random_id = lambda: (rng.randrange(1, size + 1),)
+    new_entry = next(synthetic.generate(1, seed=rng.randrange(1 << 30)))
+    updates = iter(range(size * 2, size * 3))
+
+    # Five pages of a tag search, each one continuing from the last id of the one before
+    def follow_pages():
+        cursor = None
+        for _ in range(5):
+            rows, has_more = arc.find_page({"tags": ["tag1"]}, ["id"], page_size=10, cursor=cursor)
+
+            if not has_more:
+                return
+
+            cursor = rows[-1][0]
+
+    return [
+        ("archive.add", lambda: arc.add(**new_entry), lambda: ()),
+        ("archive.get", lambda id: arc.get(id, ["id", "name", "tags", "link"]), random_id),
+        (
+            "archive.update",
+            lambda id: arc.update(id, {"tags": {"add": ["bench%d" % next(updates)], "sub": []}}),
+            random_id,
+        ),
+        ("archive.find tags", lambda: arc.find({"tags": ["tag1", "author:user1"]}), lambda: ()),
+        (
+            "archive.find tags+-",
+            lambda: arc.find({"tags": {"add": ["tag2"], "sub": ["score:1"]}}),
+            lambda: (),
+        ),
+        ("archive.find keyword", lambda: arc.find({"keyword": "recipe game"}), lambda: ()),
+        ("archive.find link", lambda: arc.find({"link": "site42.com"}), lambda: ()),
+        (
+            "archive.find_page offset",
+            lambda: arc.find_page({"tags": ["tag3"]}, page_size=10, offset=50),
+            lambda: (),
+        ),
+        ("archive.find_page cursor", follow_pages, lambda: ()),
+        ("bot !get", lambda id: bot.handle_message("!get %d" % id, {"author": ["bench"]}), random_id),
+        (
+            "bot !find",
+            lambda: bot.handle_message("!find tags: tag1 -score:2", {"author": ["bench"]}),
+            lambda: (),
+        ),
+        (
+            "bot !add",
+            lambda: bot.handle_message(
+                '!add "site.com/%d" tags: bench' % next(updates), {"author": ["bench"]}
+            ),
+            lambda: (),
+        ),
+    ]
+
+
+def run(sizes, runs, seed=0, **options):
+    results = []
+
+    for size in sizes:
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+        rng = random.Random(seed)
+
+        start = time.perf_counter()
+        synthetic.populate(arc, size, seed=seed, **options)
+        elapsed = time.perf_counter() - start
+
+        results.append(
+            {"operation": "populate", "size": size, "entries_per_s": size / elapsed}
+        )
+        print("%8d %-26s %10.0f entries/s" % (size, "populate", size / elapsed), file=sys.stderr)
+
+        for name, fn, setup in operations(arc, bot, size, rng):
+            # The archive logs every change, keep that out of the output and out of the timings
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = measure(fn, runs, setup)
+
+            results.append({"operation": name, "size": size, **result})
+            print("%8d %-26s %10.3fms" % (size, name, result["median_ms"]), file=sys.stderr)
+
+        arc.close()
+
+    return results
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+# Prints how the median of each operation changed between two runs
+def compare(baseline, results):
+    old = {(r["operation"], r["size"]): r for r in baseline["results"]}
+
+    for new in results["results"]:
+        before = old.get((new["operation"], new["size"]))
+
+        if not before or "median_ms" not in new:
+            continue
+
+        ratio = new["median_ms"] / before["median_ms"]
+        print(
+            "%8d %-26s %10.3fms -> %10.3fms  x%.2f"
+            % (new["size"], new["operation"], before["median_ms"], new["median_ms"], ratio)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the archive and the bot")
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--authors", type=int, default=50)
+    parser.add_argument("--files", type=float, default=0.01)
+    parser.add_argument("--file-size", type=int, default=4096)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    options = {
+        "tags": args.tags,
+        "authors": args.authors,
+        "files": args.files,
+        "file_size": args.file_size,
+    }
+
+    # The archive logs to stdout, which may be where the results go
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(sizes, args.runs, args.seed, **options)
+
+    results = {
+        "version": version(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "time": time.time(),
+        "config": {"sizes": sizes, "runs": args.runs, "seed": args.seed, **options},
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Generates archives full of made up, but realistic looking, entries for benchmarks. The same seed
+# always generates the same entries
+import random
+
+words = (
+    "cat dog music video paper recipe game guide photo meme review news talk map song trailer "
+    "build patch release notes"
+).split()
+
+
+# Yields dicts that can be given to Archive.add_many
+#  - tags: how many different plain tags there are. Some tags are much more common than others
+#  - authors: how many different values 'author:' tags take
+#  - sites: how many different domains links point to
+#  - files: fraction of the entries that have a file instead of a link
+#  - file_size: size of those files, in bytes
+#  - notes: fraction of the entries with notes
+def generate(count, seed=0, tags=1000, authors=50, sites=200, files=0.01, file_size=4096, notes=0.1):
+    rng = random.Random(seed)
+
+    for i in range(count):
+        name = "%s %s %d" % (rng.choice(words), rng.choice(words), i)
+        entry_tags = {"tag%d" % int(tags * rng.random() ** 2) for _ in range(rng.randrange(1, 6))}
+        entry_tags.add("author:user%d" % rng.randrange(authors))
+
+        if rng.random() < 0.5:
+            entry_tags.add("score:%d" % rng.randrange(1, 11))
+
+        entry = {"name": name, "tags": sorted(entry_tags)}
+
+        if rng.random() < files:
+            # Half text-like content that compresses well, half noise that doesn't
+            if rng.random() < 0.5:
+                content = (" ".join(rng.choice(words) for _ in range(file_size // 4))).encode()
+            else:
+                content = rng.getrandbits(8 * file_size).to_bytes(file_size, "little")
+
+            entry["file"] = ("file%d.bin" % i, content[:file_size])
+        else:
+            entry["link"] = "https://site%d.com/%s/%d" % (rng.randrange(sites), rng.choice(words), i)
+
+        if rng.random() < notes:
+            entry["notes"] = ["%s %s" % (rng.choice(words), rng.choice(words))]
+
+        yield entry
+
+
+# Fills 'arc' with 'count' generated entries, added 'batch' at a time
+def populate(arc, count, batch=10000, **options):
+    entries = generate(count, **options)
+
+    while True:
+        chunk = [entry for _, entry in zip(range(batch), entries)]
+
+        if not chunk:
+            return arc
+
+        arc.add_many(chunk)
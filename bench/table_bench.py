@@ -0,0 +1,49 @@
+# Compares drawing a table with texttable against the incremental renderer, for tables of 10, 100
+# and 1000 rows like the ones !find answers with. texttable draws every row, the renderer stops once
+# the table fills a message
+#
+# Usage: python -m bench.table_bench [rounds]
+import random
+import sys
+import timeit
+
+import table
+
+headers = ["id", "name", "tags", "link"]
+
+
+def generate(count, seed=0):
+    rng = random.Random(seed)
+
+    return [
+        (
+            i,
+            "entry %d" % rng.randrange(1 << 20),
+            ["tag%d" % rng.randrange(100) for _ in range(rng.randrange(1, 6))],
+            "https://site%d.com/%s" % (rng.randrange(100), "x" * rng.randrange(10, 80)),
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+def main(rounds=20):
+    print("%6s %14s %14s %8s %8s" % ("rows", "texttable", "render", "chars", "chars"))
+
+    for count in [10, 100, 1000]:
+        rows = generate(count)
+
+        drawn = table.tabulate(table.prepare(rows), 150, headers)
+        rendered = table.render(rows, 150, headers)
+
+        old = min(timeit.repeat(lambda: table.tabulate(table.prepare(rows), 150, headers),
+                                number=1, repeat=rounds))
+        new = min(timeit.repeat(lambda: table.render(rows, 150, headers), number=1, repeat=rounds))
+
+        print(
+            "%6d %12.3fms %12.3fms %8d %8d"
+            % (count, old * 1000, new * 1000, len(drawn), len(rendered))
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
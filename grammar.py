@@ -1,14 +1,57 @@
 from lark import Lark
+from lark import Token
 from lark import exceptions
 from lark import Transformer
 import os
+import re
 
 
-def build_grammar():
-    grammar_file = os.path.join(os.path.dirname(__file__), "command_grammar.lark")
+grammar_file = os.path.join(os.path.dirname(__file__), "command_grammar.lark")
+cache_file = os.path.join(os.path.dirname(__file__), "command_grammar.cache")
 
+
+# Names of the parameters commands take
+parameters = ["link", "name", "tags", "notes", "since", "until", "order", "page", "after"]
+
+
+# A parameter can be written without a space after the colon, like tags:foo. The lexer can't tell
+# that from a tag like author:foo, so words are split here instead: a word that starts with the
+# name of a parameter opens it, unless a parameter is open already. In tags: foo name:bar, name:bar
+# is still a tag
+class InlineParameters:
+    always_accept = ()
+    pattern = re.compile(r"(%s):(.+)" % "|".join(parameters))
+
+    def process(self, stream):
+        open = False
+
+        for token in stream:
+            match = not open and token.type == "WSTRING" and self.pattern.fullmatch(token)
+
+            if match:
+                key, value = match.groups()
+                kind = "NUMBER" if value.isdigit() else "WSTRING"
+
+                yield Token.new_borrow_pos("KEY", key + ":", token)
+                yield Token.new_borrow_pos(kind, value, token)
+
+            else:
+                yield token
+
+            open = open or token.type == "KEY" or bool(match)
+
+
+# Builds an LALR parser for the grammar. Building the parse table is the slow part, so it's
+# saved to 'cache' and loaded from there next time. Lark checks the grammar hasn't changed since
+def build_grammar(cache=cache_file):
     with open(grammar_file, "r") as file:
-        return Lark(file.read(), start="command")
+        text = file.read()
+
+    try:
+        return Lark(text, start="command", parser="lalr", postlex=InlineParameters(), cache=cache)
+    except OSError:
+        # We can't write the cache, so we have to build the parser every time
+        return Lark(text, start="command", parser="lalr", postlex=InlineParameters())
 
 
 class Add:
@@ -39,6 +82,22 @@ class Sub:
         return isinstance(obj, Sub) and obj.value == self.value
 
 
+# Comparison with a value, like >=4
+class Compare:
+    def __init__(self, op, value):
+        self.op = op
+        self.value = value
+
+    def __str__(self):
+        return "Compare(%s %s)" % (self.op, self.value)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __eq__(self, obj):
+        return isinstance(obj, Compare) and (obj.op, obj.value) == (self.op, self.value)
+
+
 # Transforms the tree generated by lark into what we actually want
 class CommandTransformer(Transformer):
     def STRING(self, s):
@@ -47,6 +106,9 @@ class CommandTransformer(Transformer):
     def command(self, args):
         return args
 
+    def KEY(self, s):
+        return s[:-1].rstrip()
+
     def named_parameter(self, args):
         return (args[0], args[1:])
 
@@ -59,6 +121,9 @@ class CommandTransformer(Transformer):
     def minus_value(self, args):
         return Sub(args[0])
 
+    def compare_value(self, args):
+        return Compare(str(args[0]), args[1])
+
     list = list
     command_body = list
     WORD = str
@@ -0,0 +1,106 @@
+import collections
+import json
+import sqlite3
+import time
+
+
+# Remembers which answer the bot sent for each command message, so that editing the command can
+# edit the answer too. Recent records stay in memory, and every record is also written to a small
+# SQLite table, so a restart (or a message that fell out of memory) doesn't lose track of it.
+# Records older than the ttl are forgotten.
+class EditHistory:
+    def __init__(self, db_file, capacity=1024, ttl=7 * 24 * 60 * 60, clock=time.time):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = collections.OrderedDict()
+        self.writes = 0
+
+        # Runs on the event loop, so commits shouldn't wait for the disk. In WAL mode, NORMAL only
+        # syncs at checkpoints, and a crash can lose the last few records at worst
+        self.con = sqlite3.connect(db_file)
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS edit_history (
+                message_id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                answer_id INTEGER NOT NULL,
+                edits TEXT,
+                mtime REAL NOT NULL
+            )"""
+        )
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS edit_history_mtime ON edit_history (mtime)"
+        )
+        self.expire()
+
+    def close(self):
+        self.con.close()
+
+    def __len__(self):
+        return len(self.cache)
+
+    # Remember that the command 'message_id' was answered by 'answer_id' in 'channel_id'
+    def put(self, message_id, channel_id, answer_id, edits):
+        now = self.clock()
+        record = (channel_id, answer_id, edits)
+
+        with self.con:
+            self.con.execute(
+                "INSERT OR REPLACE INTO edit_history VALUES (?, ?, ?, ?, ?)",
+                (message_id, channel_id, answer_id, json.dumps(edits), now),
+            )
+
+        self.remember(message_id, record, now)
+
+        # Clear out stale rows every now and then, so the table stays small
+        self.writes += 1
+        if self.writes % self.capacity == 0:
+            self.expire()
+
+    # Returns (channel_id, answer_id, edits) for a command message, or None if we don't know it
+    def get(self, message_id):
+        now = self.clock()
+
+        if message_id in self.cache:
+            record, mtime = self.cache[message_id]
+
+            if now - mtime <= self.ttl:
+                self.cache.move_to_end(message_id)
+                return record
+
+            del self.cache[message_id]
+            return None
+
+        row = self.con.execute(
+            "SELECT channel_id, answer_id, edits, mtime FROM edit_history WHERE message_id = ?",
+            (message_id,),
+        ).fetchone()
+
+        if not row or now - row[3] > self.ttl:
+            return None
+
+        channel_id, answer_id, edits, mtime = row
+        record = (channel_id, answer_id, json.loads(edits))
+        self.remember(message_id, record, mtime)
+
+        return record
+
+    # Forget records older than the ttl
+    def expire(self):
+        cutoff = self.clock() - self.ttl
+
+        with self.con:
+            self.con.execute("DELETE FROM edit_history WHERE mtime < ?", (cutoff,))
+
+        for message_id in [id for id, (_, mtime) in self.cache.items() if mtime < cutoff]:
+            del self.cache[message_id]
+
+    def remember(self, message_id, record, mtime):
+        self.cache[message_id] = (record, mtime)
+        self.cache.move_to_end(message_id)
+
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
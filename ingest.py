@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import tempfile
+
+
+class TooLarge(Exception):
+    pass
+
+
+# Copies a stream of chunks into a temporary file, hashing it on the way. The file stays in memory
+# while it's small and moves to disk after spool_size bytes, so big uploads never sit in memory
+async def spool(name, chunks, max_size, spool_size=1024 * 1024):
+    file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    hash = hashlib.sha256()
+    size = 0
+
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise TooLarge("%s is bigger than the maximum of %d bytes." % (name, max_size))
+
+            hash.update(chunk)
+            file.write(chunk)
+
+    except BaseException:
+        file.close()
+        raise
+
+    file.seek(0)
+    return name, file, hash.hexdigest()
+
+
+# Streams an attachment's content from discord
+async def download(attachment, chunk_size=64 * 1024):
+    # discord.py depends on aiohttp, we only need it here
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+
+# Reads every attachment of a message at the same time. Returns a list of (name, file, sha256),
+# ready to be given to the archive. Attachments over max_size are refused before reading anything
+async def ingest(attachments, max_size, fetch=download):
+    for attachment in attachments:
+        if attachment.size > max_size:
+            raise TooLarge(
+                "%s is bigger than the maximum of %d bytes." % (attachment.filename, max_size)
+            )
+
+    uploads = await asyncio.gather(
+        *(spool(a.filename, fetch(a), max_size) for a in attachments), return_exceptions=True
+    )
+
+    errors = [upload for upload in uploads if isinstance(upload, BaseException)]
+    if errors:
+        for upload in uploads:
+            if not isinstance(upload, BaseException):
+                upload[1].close()
+
+        raise errors[0]
+
+    return uploads
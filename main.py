@@ -1,21 +1,43 @@
 import os
-import io
 import archive_bot
 import archive
+import async_bot
+import ingest
+import history
 import discord
+import metrics
+import sqltrace
+import asyncio
 import table
 
 # Get secret token from an environment variable
 token = os.getenv("BOT_TOKEN")
 assert token, "Environment variable BOT_TOKEN must be defined"
 
-arc = archive.Archive("test.db")
-bot = archive_bot.ArchiveBot(arc)
+# Biggest attachment we accept, in bytes
+max_upload_size = int(os.getenv("MAX_UPLOAD_SIZE", 25 * 1024 * 1024))
+
+# Optional file where metrics are written for Prometheus to collect, and how often
+metrics_file = os.getenv("METRICS_FILE")
+metrics_interval = int(os.getenv("METRICS_INTERVAL", 15))
+metrics_task = None
+
+# Setting SLOW_QUERY_MS traces every SQL statement, and logs the ones slower than that
+slow_query_ms = os.getenv("SLOW_QUERY_MS")
+tracer = sqltrace.Tracer(float(slow_query_ms) / 1000) if slow_query_ms else None
+
+arc = archive.Archive("test.db", tracer=tracer)
+bot = async_bot.AsyncArchiveBot(archive_bot.ArchiveBot(arc))
 client = discord.Client()
 
 colors = {"error": 0xFF0000}
 
-history = {}
+# Remembers the answer to each command, so that editing a command updates its answer
+edit_history = history.EditHistory(
+    "history.db",
+    capacity=int(os.getenv("HISTORY_CAPACITY", 1024)),
+    ttl=int(os.getenv("HISTORY_TTL", 7 * 24 * 60 * 60)),
+)
 
 
 def compress_text(msg):
@@ -37,19 +59,41 @@ async def answer_query(message, edits=None):
     # Extract data from the discord message
     input = message.content
     extra = {"author": [message.author.name]}
+    answer = None
 
     if message.attachments:
-        name = message.attachments[0].filename
-        data = await message.attachments[0].read()
-        extra["file"] = name, data
+        try:
+            extra["file"] = await ingest.ingest(message.attachments, max_upload_size)
+        except ingest.TooLarge as error:
+            answer = {"error": str(error), "edits": edits}
 
     if edits:
         extra["edits"] = edits
 
-    # Process the message
-    answer = bot.handle_message(input, extra)
+    # Process the message, away from the event loop
+    if not answer:
+        answer = await bot.handle_message(input, extra)
+
+    # A command that takes too long answers with a notice, and goes on reading the uploads until
+    # it's done. Its real answer comes from 'pending'
+    pending = answer.pop("pending", None)
+    files = extra.get("file", [])
+
+    if pending:
+        pending.add_done_callback(lambda _: close_files(files))
+    else:
+        close_files(files)
+
+    return (*prepare_answer(answer), pending)
+
+
+def close_files(files):
+    for name, file, sha256 in files:
+        file.close()
+
 
-    # Prepare an answer with the result
+# Turns the answer of the bot into the arguments to send it to discord with
+def prepare_answer(answer):
     if "error" in answer:
         embed = discord.Embed(
             title="error", description=answer["error"], color=colors["error"]
@@ -73,13 +117,16 @@ async def answer_query(message, edits=None):
     extras = {}
     if answer.get("table", None):
         rows, col_names = answer["table"]
-        rows = table.prepare(rows)
-        args.append("```%s```" % table.tabulate(rows, 150, col_names))
+
+        # The code block around the table takes 6 characters of the message
+        text = table.render(rows, 150, col_names, table.message_limit - 6)
+        args.append("```%s```" % text)
 
     if answer.get("file", None):
-        name, data = answer["file"]
+        name, handle = answer["file"]
 
-        extras["file"] = discord.File(io.BytesIO(data), filename=name)
+        # The handle reads the file from the archive as discord uploads it
+        extras["file"] = discord.File(handle, filename=name)
 
     if answer.get("link", None):
         args.append(answer["link"])
@@ -143,58 +190,121 @@ async def on_message(message):
         if not should_answer_message(message):
             return
 
-        args, extras, edit_info = await answer_query(message)
+        args, extras, edit_info, pending = await answer_query(message)
         msg = await message.channel.send(*map(compress_text, args), **extras)
 
         # Save some info so that what to edit later
-        history[message.id] = (edit_info, msg)
+        edit_history.put(message.id, msg.channel.id, msg.id, edit_info)
+
+        if pending:
+            await replace_notice(msg, message.id, pending)
 
     except Exception as e:
         await send_fail_message(message.channel, e)
 
 
+# Arguments to turn an answer that was sent already into a new one. Editing can't add files
+def edit_arguments(args, extras):
+    if args:
+        extras["content"] = compress_text(args[0])
+    else:
+        extras["content"] = ""
+
+    if extras.get("file", None):
+        extras["file"] = None
+
+    extras["embed"] = extras.get("embed", None)
+
+    return extras
+
+
+# Waits for the answer to a command that outlived its timeout, and puts it in place of the notice
+# sent meanwhile. The history gets the real edits, so editing the command replaces what it did
+async def replace_notice(notice, message_id, pending):
+    args, extras, edit_info = prepare_answer(await pending)
+
+    await notice.edit(**edit_arguments(args, extras))
+    edit_history.put(message_id, notice.channel.id, notice.id, edit_info)
+
+
+# Fetch a message from discord, unless it has been deleted since
+async def fetch_message(channel_id, message_id):
+    channel = client.get_channel(channel_id) or await client.fetch_channel(channel_id)
+
+    try:
+        return await channel.fetch_message(message_id)
+    except discord.NotFound:
+        return None
+
+
+# The raw event fires even for messages that are no longer in discord.py's message cache, such as
+# the ones sent before a restart
 @client.event
-async def on_message_edit(before, after):
+async def on_raw_message_edit(payload):
+    channel = None
+
     try:
-        if not should_answer_message(after):
+        # Edits that don't touch the content, such as link previews being embedded, are ignored
+        if "content" not in payload.data:
             return
 
-        if not before.id in history:
-            print("Message has been edited, but it is not in cache - ignored.")
+        record = edit_history.get(payload.message_id)
+
+        if not record:
+            print("Message has been edited, but it is not in history - ignored.")
             return
 
-        (edits, old_answer) = history[before.id]
+        channel_id, answer_id, edits = record
+        after = await fetch_message(payload.channel_id, payload.message_id)
+        old_answer = await fetch_message(channel_id, answer_id)
+
+        if not after or not old_answer or not should_answer_message(after):
+            return
+
+        channel = old_answer.channel
 
         # This usually happens when the answer was an error
         if not edits:
             edits = {"type": "no-type"}
 
-        args, extras, edit_info = await answer_query(after, edits)
+        args, extras, edit_info, pending = await answer_query(after, edits)
 
-        if args:
-            extras["content"] = compress_text(args[0])
-        else:
-            extras["content"] = ""
+        await old_answer.edit(**edit_arguments(args, extras))
+        edit_history.put(after.id, channel_id, answer_id, edit_info)
 
-        if extras.get("file", None):
-            extras["file"] = None
+        if pending:
+            await replace_notice(old_answer, after.id, pending)
 
-        extras["embed"] = extras.get("embed", None)
+    except Exception as e:
+        print("Could not update the answer to an edited message:", repr(e))
 
-        await old_answer.edit(**extras)
-        history[after.id] = (edit_info, old_answer)
+        if channel:
+            await send_fail_message(channel, e)
 
-    except Exception as e:
-        await send_fail_message(old_answer.channel, e)
+
+async def dump_metrics():
+    while True:
+        try:
+            metrics.registry.dump(metrics_file)
+        except OSError as e:
+            print("Could not write metrics:", e)
+
+        await asyncio.sleep(metrics_interval)
 
 
 @client.event
 async def on_ready():
+    global metrics_task
+
     print("Logged in as")
     print(client.user.name)
     print(client.user.id)
     print("------")
 
+    # on_ready runs again after every reconnection, but one writer is enough
+    if metrics_file and not metrics_task:
+        metrics_task = client.loop.create_task(dump_metrics())
+
 
 # Start the bot. We can comment this out to run commands manually
 client.run(token)
@@ -0,0 +1,226 @@
+import contextlib
+import functools
+import os
+import threading
+import time
+
+
+# Latency histogram with fixed buckets, so it takes the same memory after a million observations as
+# after one. Bucket bounds are in seconds, from half a millisecond up to about 16 seconds
+class Histogram:
+    bounds = [0.0005 * 2 ** i for i in range(16)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    # Estimates the q-th quantile by interpolating inside the bucket it falls in, the same way
+    # Prometheus does
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return self.bounds[-1]
+
+
+# Everything recorded about a single command or method
+class Stats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.statements = 0
+        self.rows = 0
+        self.steps = 0
+
+
+# Work done by a call that is still running. Statements and rows are charged to every scope open in
+# the thread, so a command also accounts for the archive calls it makes
+class Scope:
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.steps = 0
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+class Registry:
+    # The progress handler runs every this many SQLite virtual machine instructions
+    step_size = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = {}
+        self.gauges = {}
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def scopes(self):
+        if not hasattr(self.local, "scopes"):
+            self.local.scopes = []
+
+        return self.local.scopes
+
+    # Times the code inside it and records it under kind/name. Exceptions count as errors, and so
+    # does calling fail on the scope
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        scopes = self.scopes()
+        scope = Scope()
+        scopes.append(scope)
+        start = time.perf_counter()
+
+        try:
+            yield scope
+        except BaseException:
+            scope.fail()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            scopes.pop()
+
+            with self.lock:
+                stats = self.stats.setdefault((kind, name), Stats())
+                stats.latency.observe(elapsed)
+                stats.errors += scope.failed
+                stats.statements += scope.statements
+                stats.rows += scope.rows
+                stats.steps += scope.steps
+
+    def statement(self, _sql=None):
+        for scope in self.scopes():
+            scope.statements += 1
+
+    def add_rows(self, count):
+        for scope in self.scopes():
+            scope.rows += count
+
+    def step(self):
+        for scope in self.scopes():
+            scope.steps += self.step_size
+
+        # Returning anything true would abort the query
+        return 0
+
+    # Counts the statements run on a connection, and roughly how much work they take
+    def watch(self, connection):
+        connection.set_trace_callback(self.statement)
+        connection.set_progress_handler(self.step, self.step_size)
+
+    # Reports the values returned by 'fn', a dict of numbers, along with the rest
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    # Copy of everything recorded, as a list of dicts sorted by kind and name
+    def snapshot(self):
+        with self.lock:
+            items = sorted(self.stats.items())
+
+            return [
+                {
+                    "kind": kind,
+                    "name": name,
+                    "count": stats.latency.count,
+                    "errors": stats.errors,
+                    "seconds": stats.latency.sum,
+                    "p50": stats.latency.quantile(0.5),
+                    "p95": stats.latency.quantile(0.95),
+                    "p99": stats.latency.quantile(0.99),
+                    "statements": stats.statements,
+                    "rows": stats.rows,
+                    "steps": stats.steps,
+                    "buckets": list(stats.latency.counts),
+                }
+                for (kind, name), stats in items
+            ]
+
+    def read_gauges(self):
+        return {name: fn() for name, fn in sorted(self.gauges.items())}
+
+    # Everything recorded, in Prometheus' text exposition format
+    def prometheus(self):
+        lines = []
+        snapshot = self.snapshot()
+
+        for kind in sorted({s["kind"] for s in snapshot}):
+            family = "archive_%s" % kind
+            stats = [s for s in snapshot if s["kind"] == kind]
+
+            lines.append("# TYPE %s_seconds histogram" % family)
+            for s in stats:
+                label = '%s="%s"' % (kind, s["name"])
+                total = 0
+
+                for bound, count in zip([*Histogram.bounds, "+Inf"], s["buckets"]):
+                    total += count
+                    le = bound if bound == "+Inf" else repr(bound)
+                    lines.append('%s_seconds_bucket{%s,le="%s"} %d' % (family, label, le, total))
+
+                lines.append("%s_seconds_sum{%s} %r" % (family, label, s["seconds"]))
+                lines.append("%s_seconds_count{%s} %d" % (family, label, s["count"]))
+
+            for counter in ["errors", "statements", "rows", "steps"]:
+                lines.append("# TYPE %s_%s_total counter" % (family, counter))
+                for s in stats:
+                    lines.append(
+                        '%s_%s_total{%s="%s"} %d' % (family, counter, kind, s["name"], s[counter])
+                    )
+
+        for name, values in self.read_gauges().items():
+            for key, value in sorted(values.items()):
+                lines.append("# TYPE archive_%s_%s gauge" % (name, key))
+                lines.append("archive_%s_%s %r" % (name, key, value))
+
+        return "\n".join(lines) + "\n"
+
+    # Writes the Prometheus text to 'path'. The file is replaced at once, so whatever collects it
+    # never reads half of it
+    def dump(self, path):
+        temp = "%s.tmp" % path
+
+        with open(temp, "w") as file:
+            file.write(self.prometheus())
+
+        os.replace(temp, path)
+
+
+registry = Registry()
+
+
+# Decorator that measures every call of a method, as kind/method name
+def timed(kind):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with registry.measure(kind, fn.__name__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,56 @@
+# Small SQL query builder. Every piece of a query keeps its own list of parameters, so clauses
+# can be added in any order and the parameters still end up matching the placeholders
+class Query:
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = list(columns)
+        self.joins = []
+        self.clauses = []
+        self.order = []
+        self.limit = None
+        self.offset = None
+
+    def join(self, clause, params=()):
+        self.joins.append((clause, list(params)))
+        return self
+
+    def where(self, clause, params=()):
+        self.clauses.append((clause, list(params)))
+        return self
+
+    def order_by(self, clause, params=()):
+        self.order.append((clause, list(params)))
+        return self
+
+    def paginate(self, limit=None, offset=None):
+        self.limit = limit
+        self.offset = offset
+        return self
+
+    def build(self):
+        sql = ["SELECT %s FROM %s" % (", ".join(self.columns), self.table)]
+        params = []
+
+        for clause, values in self.joins:
+            sql.append(clause)
+            params += values
+
+        if self.clauses:
+            sql.append("WHERE " + " AND ".join("(%s)" % c for c, _ in self.clauses))
+            for _, values in self.clauses:
+                params += values
+
+        if self.order:
+            sql.append("ORDER BY " + ", ".join(c for c, _ in self.order))
+            for _, values in self.order:
+                params += values
+
+        if self.limit is not None:
+            sql.append("LIMIT ?")
+            params.append(self.limit)
+
+            if self.offset:
+                sql.append("OFFSET ?")
+                params.append(self.offset)
+
+        return " ".join(sql), params
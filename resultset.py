@@ -0,0 +1,130 @@
+# Results of a find, stored by column. Columns hold the values as they come from the database and
+# are unpacked the first time they're read, all at once. Slices share the columns with the set they
+# come from, so a page of results copies nothing
+class ResultSet:
+    __slots__ = ("keys", "columns", "unpackf", "start", "stop")
+
+    def __init__(self, keys, columns, unpackf=None, start=0, stop=None):
+        self.keys = tuple(keys)
+        self.columns = columns
+        self.unpackf = unpackf or [None] * len(self.keys)
+        self.start = start
+        self.stop = len(columns[0]) if stop is None and columns else stop or 0
+
+    # Builds a set from database rows, with a function to unpack each column
+    @classmethod
+    def from_rows(cls, keys, rows, unpackf=None):
+        columns = list(zip(*rows)) if rows else [() for _ in keys]
+
+        return cls(keys, columns, unpackf)
+
+    def column(self, i):
+        unpack = self.unpackf[i]
+
+        # Unpacked in place, so every slice of the same columns sees it done
+        if unpack is not None:
+            self.columns[i] = [unpack(value) for value in self.columns[i]]
+            self.unpackf[i] = None
+
+        return self.columns[i]
+
+    def index(self, key):
+        return self.keys.index(key) if isinstance(key, str) else key
+
+    def value(self, row, key):
+        return self.column(self.index(key))[row]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, "Result sets can only be sliced in order"
+
+            start, stop = self.start + start, self.start + max(start, stop)
+            return ResultSet(self.keys, self.columns, self.unpackf, start, stop)
+
+        if i < 0:
+            i += len(self)
+
+        if not 0 <= i < len(self):
+            raise IndexError("result index out of range")
+
+        return ResultRow(self, self.start + i)
+
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield ResultRow(self, i)
+
+    # Compares equal to any sequence with the same rows, like a list of tuples
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return repr([tuple(row) for row in self])
+
+    # Splits the 'key' column in two with 'split', which turns a value into the value to keep and a
+    # dict of extra columns. Extra columns are added after the others, sorted, and rows without one
+    # get None. Only the rows of this set are split, the other rows sharing its columns are not
+    def expand(self, key, split):
+        i = self.index(key)
+        size = len(self.columns[i])
+
+        parts = [split(self.value(row, i)) for row in range(self.start, self.stop)]
+        names = sorted({name for _, extra in parts for name in extra})
+
+        kept = [None] * size
+        extras = {name: [None] * size for name in names}
+
+        for row, (value, extra) in enumerate(parts, self.start):
+            kept[row] = value
+
+            for name, value in extra.items():
+                extras[name][row] = value
+
+        columns = [*self.columns, *extras.values()]
+        columns[i] = kept
+
+        unpackf = [*self.unpackf, *[None] * len(names)]
+        unpackf[i] = None
+
+        return ResultSet([*self.keys, *names], columns, unpackf, self.start, self.stop)
+
+
+# A row of a result set, which reads its values from the set's columns
+class ResultRow:
+    __slots__ = ("results", "row")
+
+    def __init__(self, results, row):
+        self.results = results
+        self.row = row
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return tuple(self)[key]
+
+        return self.results.value(self.row, key)
+
+    def __len__(self):
+        return len(self.results.keys)
+
+    def __iter__(self):
+        for i in range(len(self.results.keys)):
+            yield self.results.value(self.row, i)
+
+    # Compares equal to tuples and lists with the same values
+    def __eq__(self, other):
+        if isinstance(other, (ResultRow, tuple, list)):
+            return tuple(self) == tuple(other)
+
+        return NotImplemented
+
+    def __lt__(self, other):
+        return tuple(self) < tuple(other)
+
+    def __repr__(self):
+        return repr(tuple(self))
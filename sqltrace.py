@@ -0,0 +1,184 @@
+import collections
+import re
+import sqlite3
+import threading
+import time
+
+
+# Turns a statement into its shape: the same statement with literals replaced by ?, lists of
+# parameters collapsed and whitespace normalized. Statements built with different values, or with a
+# different number of tags, end up with the same shape
+def normalize(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"--[^\n]*", "", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", sql)
+
+    return " ".join(sql.split())
+
+
+# Whether a query plan reads a whole table or index, instead of seeking into it
+def has_scan(plan):
+    return any(detail.startswith("SCAN") for detail in plan)
+
+
+# Everything recorded about statements of the same shape
+class Shape:
+    def __init__(self, sql, plan):
+        self.sql = sql
+        self.plan = plan
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.slow = 0
+
+
+# Times every statement run on the connections it traces. Statements that take longer than
+# 'threshold' seconds are logged along with their query plan. Every shape is explained once, the
+# first time it's seen, so full scans show up even when they're still fast
+class Tracer:
+    def __init__(self, threshold=0.1, log=print, max_slow=100):
+        self.threshold = threshold
+        self.log = log
+        self.lock = threading.Lock()
+        self.shapes = {}
+        self.slow = collections.deque(maxlen=max_slow)
+
+    # Query plan for a statement, as a list of steps. Statements that can't be explained, such as
+    # PRAGMAs, have an empty plan
+    def explain(self, connection, sql, params):
+        try:
+            cursor = sqlite3.Cursor(connection)
+            return [row[3] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error:
+            return []
+
+    def record(self, connection, sql, params, elapsed):
+        shape_sql = normalize(sql)
+
+        with self.lock:
+            shape = self.shapes.get(shape_sql)
+
+        if shape is None:
+            shape = Shape(shape_sql, self.explain(connection, sql, params))
+
+            with self.lock:
+                shape = self.shapes.setdefault(shape_sql, shape)
+
+        with self.lock:
+            shape.count += 1
+            shape.seconds += elapsed
+            shape.max = max(shape.max, elapsed)
+
+            if elapsed < self.threshold:
+                return
+
+            shape.slow += 1
+
+        plan = self.explain(connection, sql, params)
+        self.slow.append((time.time(), sql, params, elapsed, plan))
+        self.log(
+            "slow query: %.1fms %s %r\n%s"
+            % (elapsed * 1000, " ".join(sql.split()), params, "\n".join("  " + p for p in plan))
+        )
+
+    # Shapes that took the most time in total, first
+    def report(self, limit=None):
+        with self.lock:
+            shapes = sorted(self.shapes.values(), key=lambda shape: -shape.seconds)
+
+        return shapes[:limit]
+
+
+# Cursor that reports how long each statement took, counting both running it and fetching its rows.
+# A statement is over when its rows run out, the cursor runs another one or the cursor is closed
+class TracingCursor(sqlite3.Cursor):
+    pending = None
+
+    def finish(self):
+        if self.pending:
+            sql, params, elapsed = self.pending
+            self.pending = None
+            self.connection.tracer.record(self.connection, sql, params, elapsed)
+
+    def timed(self, sql, params, fn, *args):
+        start = time.perf_counter()
+
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+
+            if self.pending:
+                self.pending = (sql, params, self.pending[2] + elapsed)
+            else:
+                self.pending = (sql, params, elapsed)
+
+    def execute(self, sql, params=()):
+        self.finish()
+        return self.timed(sql, params, super().execute, sql, params)
+
+    def executemany(self, sql, params):
+        self.finish()
+
+        # The parameters are read twice when explaining, so they can't be a generator
+        params = list(params)
+        self.timed(sql, params[0] if params else (), super().executemany, sql, params)
+        self.finish()
+
+        return self
+
+    def fetch(self, fn, *args):
+        if not self.pending:
+            return fn(*args)
+
+        sql, params, _ = self.pending
+        return self.timed(sql, params, fn, *args)
+
+    def __next__(self):
+        try:
+            return self.fetch(super().__next__)
+        except StopIteration:
+            self.finish()
+            raise
+
+    def fetchone(self):
+        row = self.fetch(super().fetchone)
+
+        if row is None:
+            self.finish()
+
+        return row
+
+    def fetchmany(self, *args):
+        return self.fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        rows = self.fetch(super().fetchall)
+        self.finish()
+
+        return rows
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self.finish()
+        except sqlite3.Error:
+            pass
+
+
+# Connection whose cursors are all traced by 'tracer'
+class TracingConnection(sqlite3.Connection):
+    tracer = None
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
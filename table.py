@@ -1,10 +1,13 @@
 import texttable
 import math
 
+# Discord refuses messages longer than this many characters
+message_limit = 2000
+
 
 def prepare_value(value, max_col_width=None):
     if isinstance(value, str):
-        if max_col_width and len(value > max_col_width):
+        if max_col_width and len(value) > max_col_width:
             return value[: max_col_width - 3] + "..."
 
         return value
@@ -49,3 +52,101 @@ def tabulate_dict(table, max_width):
     rows = zip(*table.values())
 
     return tabulate(rows, max_width, headers)
+
+
+# Shrinks the widest columns until a line made of them, with 'gap' characters between each one, fits
+# in 'max_width'. Columns are never shrunk below 3 characters, enough for "..."
+def fit_widths(widths, max_width, gap):
+    widths = list(widths)
+    excess = sum(widths) + gap * (len(widths) - 1) - max_width
+
+    while excess > 0:
+        widest = max(widths)
+        if widest <= 3:
+            break
+
+        # Take the widest columns down to the next widest, or less if that's enough
+        count = widths.count(widest)
+        below = max([w for w in widths if w < widest] + [3])
+        cut = min(widest - below, -(-excess // count))
+
+        widths = [w - cut if w == widest else w for w in widths]
+        excess -= cut * count
+
+    return widths
+
+
+# Formats rows into lines of fixed width columns, one at a time
+def lines(rows, widths, gap=2):
+    for row in rows:
+        cells = (prepare_value(v, w).ljust(w) for v, w in zip(row, widths))
+        yield (" " * gap).join(cells).rstrip()
+
+
+def prepare_cell(value):
+    return " ".join(prepare_value(value).splitlines())
+
+
+# Widths of the columns once 'row' is added to a table with columns of 'widths'
+def widen(widths, row):
+    widths = widths + [0] * (len(row) - len(widths))
+
+    for i, value in enumerate(row):
+        widths[i] = max(widths[i], len(value))
+
+    return widths
+
+
+# Lines of a table: the headers and a line under them, if there are any, and then the rows
+def draw(header, cells, widths, max_width, gap):
+    output = []
+
+    if header:
+        output.append(next(lines([header], widths, gap)))
+        output.append("-" * min(max_width, sum(widths) + gap * (len(widths) - 1)))
+
+    output.extend(lines(cells, widths, gap))
+
+    return output
+
+
+# Draws a table that fits in 'limit' characters, with lines no longer than 'max_width'. Rows are
+# read one at a time, and the column widths only grow to fit the rows that make it into the table.
+# Cells too wide for their column are cut short. The table ends in "..." at the first row that
+# would take it over the limit, and the rows after that one are never read
+def render(rows, max_width, headers=None, limit=message_limit, gap=2):
+    header = tuple(map(prepare_cell, headers or ()))
+    widths = widen([], header)
+    fitted = fit_widths(widths, max_width, gap)
+    cells = []
+    size = len("\n".join(draw(header, cells, fitted, max_width, gap)))
+    more = False
+
+    # Leave room for the "..." that marks the table as cut short
+    room = limit - len("\n...")
+
+    for row in rows:
+        row = tuple(map(prepare_cell, row))
+        grown = widen(widths, row)
+        refit = fit_widths(grown, max_width, gap)
+
+        # Lines drawn already only change if the widths do
+        if refit == fitted:
+            line = next(lines([row], fitted, gap))
+            added = size + bool(header or cells) + len(line)
+        else:
+            added = len("\n".join(draw(header, [*cells, row], refit, max_width, gap)))
+
+        if added > room:
+            more = True
+            break
+
+        cells.append(row)
+        widths, fitted, size = grown, refit, added
+
+    output = draw(header, cells, fitted, max_width, gap)
+
+    if more:
+        output.append("...")
+
+    return "\n".join(output)
@@ -1,7 +1,26 @@
+import hashlib
+import io
+import itertools
+import os
+import random
+import sqlite3
+import tempfile
+import threading
 import unittest
 import archive
 
 
+# Describes how SQLite runs a query, one step per line
+def query_plan(arc, sql, params):
+    return "\n".join(row[-1] for row in arc.con.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+
+# Reads the content of an unpacked file
+def read(file):
+    name, handle = file
+    return name, handle.read()
+
+
 class TestArchive(unittest.TestCase):
     def test_archive(self):
         arc = archive.Archive(":memory:")
@@ -62,3 +81,542 @@ class TestArchive(unittest.TestCase):
         assert len(arc.find({"tags": ["atag"]})) == 1
         assert len(arc.find({"keyword": "link"})) == 1
 
+
+    def test_find_matches_scan(self):
+        arc = archive.Archive(":memory:")
+
+        arc.add(name="link", link="link.com", tags=["atag", "btag"])
+        arc.add(name="other", link="other.com", tags=["other"])
+        arc.add(name="file entry", file=("notes.txt", b"some content"), tags=["atag"])
+        arc.add(link="nameless.com", tags=[])
+        arc.update(2, {"tags": ["atag"]})
+
+        for opts in [
+            {},
+            {"name": "link"},
+            {"name": ""},
+            {"link": "link.com"},
+            {"tags": ["atag"]},
+            {"tags": {"add": ["atag"], "sub": ["btag"]}},
+            {"tags": {"add": [], "sub": ["other"]}},
+            {"keyword": "link"},
+            {"keyword": "notes"},
+            {"keyword": "com", "tags": ["atag"]},
+            {"page": [1]},
+        ]:
+            self.assertEqual(arc.find(opts), arc.find_scan(opts), opts)
+
+    def test_entry_tags_backfill(self):
+        with tempfile.TemporaryDirectory() as dir:
+            db_file = os.path.join(dir, "archive.db")
+
+            arc = archive.Archive(db_file)
+            arc.add(name="link", link="link.com", tags=["a", "b"])
+            arc.add(name="other", link="other.com", tags=["b"])
+
+            # Pretend the database was created before the index existed
+            arc.con.execute("DELETE FROM entry_tags")
+            arc.con.execute("PRAGMA user_version = 0")
+            arc.db.commit()
+            arc.db.close()
+
+            arc = archive.Archive(db_file)
+            self.assertEqual([(2,), (1,)], arc.find({"tags": ["b"]}, ["id"]))
+            self.assertEqual([(1,)], arc.find({"tags": {"add": ["b"], "sub": []}, "name": "link"}, ["id"]))
+            arc.close()
+
+    def test_find_keyword(self):
+        arc = archive.Archive(":memory:")
+
+        arc.add(name="cooking", link="recipes.com", notes=["bake the bread slowly"])
+        arc.add(name="bread bread bread", link="bread.com")
+        arc.add(name="other", file=("bread.txt", b"content"))
+        arc.add(name="unrelated", link="unrelated.com")
+
+        self.assertEqual([(3,), (2,), (1,)], arc.find({"keyword": "bread"}, ["id"]))
+        self.assertEqual((2,), arc.find({"keyword": "bread"}, ["id"], "rank")[0])
+
+        # Matches are case sensitive substrings, as before
+        self.assertEqual([], arc.find({"keyword": "Bread"}, ["id"]))
+        self.assertEqual([(1,)], arc.find({"keyword": "ake"}, ["id"]))
+
+        # Too short for the index
+        self.assertEqual([(1,)], arc.find({"keyword": "ak"}, ["id"]))
+
+        # The index follows updates and deletes
+        arc.update(2, {"name": ["toast"]})
+        arc.delete(3)
+        self.assertEqual([(5,), (1,)], arc.find({"keyword": "bread"}, ["id"]))
+        self.assertEqual([(5,)], arc.find({"keyword": "toast"}, ["id"]))
+
+    def test_find_page(self):
+        arc = archive.Archive(":memory:")
+
+        for i in range(25):
+            arc.add(name="entry%d" % i, link="link%d.com" % i, tags=["even" if i % 2 else "odd"])
+
+        rows, more = arc.find_page({}, ["id"], page_size=10)
+        self.assertEqual([(id,) for id in range(25, 15, -1)], rows)
+        self.assertTrue(more)
+
+        rows, more = arc.find_page({}, ["id"], page_size=10, cursor=rows[-1][0])
+        self.assertEqual([(id,) for id in range(15, 5, -1)], rows)
+        self.assertTrue(more)
+
+        rows, more = arc.find_page({}, ["id"], page_size=10, cursor=rows[-1][0])
+        self.assertEqual([(id,) for id in range(5, 0, -1)], rows)
+        self.assertFalse(more)
+
+        # Offsets and search options work the same way
+        rows, more = arc.find_page({"tags": ["odd"]}, ["id"], page_size=5, offset=10)
+        self.assertEqual([(5,), (3,), (1,)], rows)
+        self.assertFalse(more)
+
+    def test_iter_find(self):
+        arc = archive.Archive(":memory:")
+
+        for i in range(20):
+            arc.add(name="entry%d" % i, file=("file%d.txt" % i, b"content"), tags=["t%d" % (i % 3)])
+
+        unpacked = []
+        unpack_file = arc.unpackf["file"]
+        arc.unpackf["file"] = lambda id: unpacked.append(id) or unpack_file(id)
+
+        rows = arc.iter_find({"tags": ["t0"]}, ["id", "name", "file"])
+        first, second = itertools.islice(rows, 2)
+
+        # Columns are unpacked on demand, and only once
+        self.assertEqual([], unpacked)
+        self.assertEqual(("file18.txt", b"content"), read(first["file"]))
+        self.assertIs(first["file"], first[2])
+        self.assertEqual(1, len(unpacked))
+
+        self.assertEqual((16, "entry15"), tuple(second)[:2])
+        self.assertEqual(7, arc.count({"tags": ["t0"]}))
+        self.assertEqual(20, arc.count({}))
+
+    def test_find_time_and_order(self):
+        arc = archive.Archive(":memory:")
+
+        for i, name in enumerate(["b", "c", "a", None]):
+            arc.add(name=name, link="link%d.com" % i)
+
+        # Pretend entries were added one day apart
+        day = 86400
+        for id in range(1, 5):
+            arc.con.execute("UPDATE entries SET ctime = ? WHERE id = ?", [id * day, id])
+
+        self.assertEqual([(3,), (2,)], arc.find({"since": 2 * day, "until": [4 * day]}, ["id"]))
+        self.assertEqual([(4,)], arc.find({"since": 4 * day}, ["id"]))
+        self.assertEqual(2 * day, archive.parse_time("1d", now=3 * day))
+        self.assertRaises(AssertionError, archive.parse_time, "last tuesday")
+
+        self.assertEqual([(4,), (3,), (1,), (2,)], arc.find({}, ["id"], "name"))
+        self.assertEqual([(2,), (1,), (3,), (4,)], arc.find({}, ["id"], ["name", "desc"]))
+        self.assertEqual([(1,), (2,), (3,), (4,)], arc.find({}, ["id"], "ctime asc"))
+        self.assertRaises(AssertionError, arc.find, {}, ["id"], "link")
+
+        # Pages continue after the cursor in the requested order
+        rows, more = arc.find_page({}, ["id"], page_size=2, order="name")
+        self.assertEqual(([(4,), (3,)], True), (rows, more))
+        rows, more = arc.find_page({}, ["id"], page_size=2, cursor=3, order="name")
+        self.assertEqual(([(1,), (2,)], False), (rows, more))
+
+        # Updates keep the creation time
+        new_id = arc.update(1, {"name": ["d"]})
+        self.assertEqual([(new_id,)], arc.find({"until": 2 * day}, ["id"]))
+
+    def test_find_uses_indexes(self):
+        arc = archive.Archive(":memory:")
+
+        for column, order in [("entries_ctime", "ctime"), ("entries_name", "name")]:
+            sql, params = arc.plan_find({"since": 0}, ["id"], order).build()
+            plan = query_plan(arc, sql, params)
+
+            self.assertIn(column, plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_hot_queries_use_indexes(self):
+        arc = archive.Archive(":memory:")
+        columns = ["id", "name", "tags", "link"]
+
+        # Listing visible entries never reads the table
+        sql, params = arc.plan_find({}, columns).build()
+        self.assertEqual("SCAN entries USING COVERING INDEX entries_visible", query_plan(arc, sql, params))
+
+        sql, params = arc.plan_find({"tags": {"add": ["a", "b"], "sub": ["c"]}}, columns).build()
+        plan = query_plan(arc, sql, params)
+        self.assertIn("SEARCH entries USING INTEGER PRIMARY KEY", plan)
+        self.assertEqual(3, plan.count("SEARCH entry_tags USING COVERING INDEX entry_tags_tag"))
+
+        sql, params = arc.plan_find({"keyword": "abcd"}, columns).build()
+        self.assertIn("VIRTUAL TABLE INDEX", query_plan(arc, sql, params))
+
+        for sql, params, index in [
+            ("SELECT id, note FROM notes WHERE block_id = ?", [1], "notes_block"),
+            ("SELECT id FROM files WHERE blob = ? AND name = ?", [1, "a"], "files_blob"),
+            ("SELECT id, size FROM blobs WHERE hash = ?", ["a"], "sqlite_autoindex_blobs_1"),
+            (
+                "SELECT data FROM blob_chunks WHERE blob = ? AND seq = ?",
+                [1, 0],
+                "sqlite_autoindex_blob_chunks_1",
+            ),
+        ]:
+            self.assertIn("USING INDEX %s" % index, query_plan(arc, sql, params).replace("COVERING ", ""))
+
+    def test_note_blocks(self):
+        arc = archive.Archive(":memory:")
+
+        id1 = arc.add(link="a.com", notes=["one", "two"])
+        id2 = arc.add(link="b.com", notes=["three"])
+
+        self.assertEqual(["one", "two"], [note for _, note in arc.get(id1, ["notes"])[0]])
+        self.assertEqual(["three"], [note for _, note in arc.get(id2, ["notes"])[0]])
+        self.assertEqual([(1,), (2,)], arc.con.execute("SELECT notes FROM entries").fetchall())
+
+        # The sequence continues after existing blocks
+        arc.con.execute("DELETE FROM note_blocks")
+        arc.migrate_note_blocks()
+        self.assertEqual(3, arc.notes.next_block_id())
+
+    def test_files_deduplicated(self):
+        arc = archive.Archive(":memory:")
+
+        id1 = arc.add(file=("a.txt", b"same content"))
+        id2 = arc.add(file=("a.txt", b"same content"))
+        id3 = arc.add(file=("b.txt", b"same content"))
+
+        (file1,), (file2,), (file3,) = (arc.get(id, ["file"]) for id in [id1, id2, id3])
+        self.assertEqual(("a.txt", b"same content"), read(file1))
+        self.assertEqual(("b.txt", b"same content"), read(file3))
+
+        self.assertEqual([(1, 2)], arc.con.execute("SELECT COUNT(*), SUM(refs) FROM blobs").fetchall())
+        self.assertEqual([(2,)], arc.con.execute("SELECT COUNT(*) FROM files").fetchall())
+
+    def test_update_keeps_file(self):
+        arc = archive.Archive(":memory:")
+
+        id = arc.add(file=("report.txt", b"content"), tags=["a"])
+        new_id = arc.update(id, {"tags": {"add": ["b"], "sub": []}})
+
+        (file,) = arc.get(new_id, ["file"])
+        self.assertEqual(("report.txt", b"content"), read(file))
+        self.assertEqual([(new_id,)], arc.find({"keyword": "report"}, ["id"]))
+
+        # Entries updated before the fix get their file back, along the chain of updates
+        last_id = arc.update(new_id, {"name": ["renamed"]})
+
+        arc.con.execute("UPDATE entries SET file = NULL WHERE id IN (?, ?)", [new_id, last_id])
+        arc.text.unindex(last_id)
+        arc.text.index(last_id)
+
+        self.assertEqual([], arc.find({"keyword": "report"}, ["id"]))
+
+        arc.migrate_update_file()
+
+        (file,) = arc.get(last_id, ["file"])
+        self.assertEqual(("report.txt", b"content"), read(file))
+        self.assertEqual([(last_id,)], arc.find({"keyword": "report"}, ["id"]))
+
+    def test_files_migration(self):
+        with tempfile.TemporaryDirectory() as dir:
+            db_file = os.path.join(dir, "archive.db")
+
+            # Database as created by the first version of the archive
+            db = sqlite3.connect(db_file)
+            db.execute(
+                "CREATE TABLE entries (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, ctime REAL, "
+                "updates INTEGER DEFAULT 0, hidden INTEGER DEFAULT 0, tags TEXT, link TEXT, "
+                "file INTEGER, notes INTEGER)"
+            )
+            db.execute(
+                "CREATE TABLE files(id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, size INT, data BLOB)"
+            )
+            for name, data in [("a", b"one"), ("a", b"one"), ("b", b"one"), ("c", b"two")]:
+                cursor = db.execute("INSERT INTO files(name, size, data) VALUES(?, ?, ?)", [name, 3, data])
+                db.execute(
+                    "INSERT INTO entries(name, ctime, tags, file) VALUES(?, 0, '[]', ?)",
+                    [name, cursor.lastrowid],
+                )
+            db.commit()
+            db.close()
+
+            arc = archive.Archive(db_file)
+
+            self.assertEqual(
+                [("a", b"one"), ("a", b"one"), ("b", b"one"), ("c", b"two")],
+                [read(arc.get(id, ["file"])[0]) for id in range(1, 5)],
+            )
+            self.assertEqual([(1,), (1,), (3,), (4,)], arc.con.execute("SELECT file FROM entries").fetchall())
+            self.assertEqual([(2, 3)], arc.con.execute("SELECT COUNT(*), SUM(refs) FROM blobs").fetchall())
+            arc.close()
+
+    def test_tag_patterns(self):
+        arc = archive.Archive(":memory:")
+
+        arc.add(link="a.com", tags=["proj-a", "author:ann", "score:1"])
+        arc.add(link="b.com", tags=["proj-b", "author:bob"])
+        arc.add(link="c.com", tags=["project", "[x]"])
+        arc.add(link="d.com", tags=["proj-ab", "author:ann", "score:10"])
+
+        for pattern, ids in [
+            (["proj-*"], [4, 2, 1]),
+            (["proj-?"], [2, 1]),
+            (["author:?"], [4, 2, 1]),
+            ({"add": ["author:*"], "sub": ["score:?"]}, [2]),
+            ({"add": [], "sub": ["proj*", "author:bob"]}, []),
+            ({"add": [], "sub": ["author:*"]}, [3]),
+            (["score:1*", "proj-a*"], [4, 1]),
+            (["[x]"], [3]),
+            (["*"], [4, 3, 2, 1]),
+            ([2020], []),
+            ({"add": ["proj-a"], "sub": [2020]}, [1]),
+        ]:
+            found = arc.find({"tags": pattern}, ["id"])
+            self.assertEqual([(id,) for id in ids], found, pattern)
+            self.assertEqual(sorted(found), sorted(arc.find_scan({"tags": pattern}, ["id"])))
+
+        # Patterns are expanded from a range of the distinct tags
+        sql, params = arc.tags.tag_where("author:a*")
+        plan = query_plan(arc, "SELECT * FROM entry_tags WHERE " + sql, params)
+        self.assertIn("SEARCH tag_counts USING PRIMARY KEY (tag>? AND tag<?)", plan)
+
+    def test_numeric_tags(self):
+        arc = archive.Archive(":memory:")
+
+        for i, tags in enumerate([["score:4"], ["score:2.5", "year:2020"], ["score:x"], ["score:5"]]):
+            arc.add(link="link%d.com" % i, tags=tags)
+
+        for numbers, ids in [
+            ([("score", ">=", 4)], [4, 1]),
+            ([("score", ">", 2), ("score", "<", 5)], [2, 1]),
+            ([("score", "=", 2.5), ("year", "<=", 2020)], [2]),
+            ([("year", ">", 2020)], []),
+        ]:
+            found = arc.find({"numbers": numbers}, ["id"])
+            self.assertEqual([(id,) for id in ids], found, numbers)
+            self.assertEqual(found, arc.find_scan({"numbers": numbers}, ["id"]))
+
+        # Entries without the tag go last, in either direction
+        self.assertEqual([(4,), (1,), (2,), (3,)], arc.find({}, ["id"], "score desc"))
+        self.assertEqual([(2,), (1,), (4,), (3,)], arc.find({}, ["id"], "score asc"))
+        self.assertRaises(AssertionError, arc.find, {"numbers": [("score", "!", 1)]})
+
+        # Only keys some tag has can order entries, so a typo isn't taken for one
+        self.assertRaises(AssertionError, arc.find, {}, ["id"], "scroe desc")
+        self.assertRaises(AssertionError, arc.find, {}, ["id"], "nmae")
+
+        # Nor are keys without numbers
+        arc.add(link="genre.com", tags=["genre:zed"])
+        self.assertRaises(AssertionError, arc.find, {}, ["id"], "genre asc")
+
+        # Updates and deletes keep the numbers in step
+        new_id = arc.update(1, {"tags": {"add": ["score:1"], "sub": ["score:4"]}})
+        arc.delete(4)
+        self.assertEqual([(new_id,)], arc.find({"numbers": [("score", "<", 2)]}, ["id"]))
+        self.assertEqual([], arc.find({"numbers": [("score", ">=", 4)]}, ["id"]))
+
+        sql, params = arc.plan_find({"numbers": [("score", ">=", 4)]}, ["id"]).build()
+        plan = query_plan(arc, sql, params)
+        self.assertIn("SEARCH entry_numbers USING PRIMARY KEY (key=? AND value>?)", plan)
+
+    def test_facets(self):
+        arc = archive.Archive(":memory:")
+
+        arc.add(link="a.com", tags=["author:x", "a:b:c", "plain"])
+        arc.add(link="b.com", tags=["author:x", "author:y"])
+        arc.add(link="c.com", tags=["author:y"])
+        arc.update(3, {"tags": {"add": ["author:z"], "sub": ["author:y"]}})
+        arc.delete(1)
+
+        self.assertEqual([("x", 1), ("y", 1), ("z", 1)], arc.facets("author"))
+        self.assertEqual([("author", 3, 3)], arc.facets())
+        self.assertEqual([("x", 1)], arc.facets("author", limit=1))
+
+        # The counts are the same as counting the index again
+        recount = "SELECT tag, COUNT(*) FROM entry_tags GROUP BY tag"
+        counts = "SELECT tag, count FROM tag_counts ORDER BY tag"
+        self.assertEqual(arc.con.execute(recount).fetchall(), arc.con.execute(counts).fetchall())
+
+        arc.con.execute("DELETE FROM tag_counts")
+        arc.migrate_tag_counts()
+        self.assertEqual([("x", 1), ("y", 1), ("z", 1)], arc.facets("author"))
+
+        plan = query_plan(arc, "SELECT value, count FROM tag_counts WHERE key = ?", ["author"])
+        self.assertIn("tag_counts_key", plan)
+
+    def test_link_keys(self):
+        self.assertEqual("example.com/a?b=1", archive.link_key("https://www.EXAMPLE.com:443/a/?b=1#c"))
+        self.assertEqual("example.com:8080", archive.link_key("http://example.com:8080/"))
+
+        arc = archive.Archive(":memory:")
+        id = arc.add(link="www.example.com/a")
+
+        self.assertEqual(id, arc.find_link("http://example.com/a/"))
+        self.assertEqual(None, arc.find_link("example.com/b"))
+
+        # One probe into the index of visible links
+        sql = "SELECT id FROM entries WHERE link_key = ? AND hidden = 0 ORDER BY id LIMIT 1"
+        plan = query_plan(arc, sql, ["example.com/a"])
+        self.assertIn("SEARCH entries USING COVERING INDEX entries_link_key", plan)
+
+        arc.delete(id)
+        self.assertEqual(None, arc.find_link("example.com/a"))
+
+        # Only a scheme at the start makes a link complete
+        self.assertEqual(
+            "https://example.com/r?to=https://foo.com",
+            archive.complete_link("example.com/r?to=https://foo.com"),
+        )
+        self.assertRaises(AssertionError, archive.complete_link, "https://not a link")
+
+    def test_files_known_hash(self):
+        arc = archive.Archive(":memory:")
+
+        content = b"some content"
+        sha256 = hashlib.sha256(content).hexdigest()
+        arc.add(file=("a.txt", content))
+
+        # The content isn't even read when its hash is already stored
+        unread = io.BytesIO(content)
+        id = arc.add(file=("b.txt", unread, sha256))
+
+        self.assertEqual(0, unread.tell())
+        self.assertEqual(("b.txt", content), read(arc.get(id, ["file"])[0]))
+        self.assertEqual([(1,)], arc.con.execute("SELECT COUNT(*) FROM blobs").fetchall())
+
+    def test_files_chunked(self):
+        arc = archive.Archive(":memory:")
+        arc.files.chunk_size = 4
+
+        content = bytes(range(30))
+        id1 = arc.add(file=("stream.bin", io.BytesIO(content)))
+        id2 = arc.add(file=("bytes.bin", content))
+
+        self.assertEqual([(8,)], arc.con.execute("SELECT COUNT(*) FROM blob_chunks").fetchall())
+
+        for id in [id1, id2]:
+            name, handle = arc.get(id, ["file"])[0]
+            self.assertEqual(content, handle.read())
+
+            # Random access only reads the chunks it needs
+            handle.seek(6)
+            self.assertEqual(content[6:13], handle.read(7))
+            handle.seek(-3, io.SEEK_END)
+            self.assertEqual(content[-3:], handle.read())
+            self.assertEqual(b"", handle.read())
+
+    def test_files_compressed(self):
+        arc = archive.Archive(":memory:")
+        arc.files.chunk_size = 1024
+
+        text = b"".join(b"line %d of a very repetitive text file\n" % i for i in range(200))
+        noise = random.Random(0).randbytes(3000)
+        png = b"\x89PNG" + text
+
+        ids = [arc.add(file=(name, data)) for name, data in [("a.txt", text), ("b", noise), ("c.png", png)]]
+
+        codecs = arc.con.execute("SELECT codec FROM blobs ORDER BY id").fetchall()
+        self.assertEqual([("zlib",), ("raw",), ("raw",)], codecs)
+
+        (stored,) = arc.con.execute("SELECT SUM(length(data)) FROM blob_chunks WHERE blob = 1").fetchone()
+        self.assertLess(stored, len(text) / 2)
+
+        for id, data in zip(ids, [text, noise, png]):
+            name, handle = arc.get(id, ["file"])[0]
+            self.assertEqual(data, handle.read())
+
+            handle.seek(1500)
+            self.assertEqual(data[1500:1600], handle.read(100))
+
+        # Files stored before compression existed are compressed in the background
+        arc.files.codec = None
+        id = arc.add(file=("old.txt", text + b"old"))
+        arc.con.execute("UPDATE blobs SET codec = NULL WHERE id = 4")
+        arc.con.execute("UPDATE blob_chunks SET codec = NULL WHERE blob = 4")
+        arc.files.codec = "lzma"
+
+        # A file being read while it's compressed still reads right
+        name, handle = arc.get(id, ["file"])[0]
+        start = handle.read(1500)
+
+        self.assertEqual(1, arc.compress_files(limit=5))
+        self.assertEqual(0, arc.compress_files())
+        self.assertEqual(text + b"old", start + handle.read())
+
+        codecs = arc.con.execute("SELECT codec FROM blobs ORDER BY id").fetchall()
+        self.assertEqual([("zlib",), ("raw",), ("raw",), ("lzma",)], codecs)
+        self.assertEqual(text + b"old", arc.get(id, ["file"])[0][1].read())
+
+    def test_add_many(self):
+        arc = archive.Archive(":memory:")
+        arc.add(name="first", link="first.com")
+
+        ids = arc.add_many(
+            [
+                {"name": "a", "link": "a.com", "tags": ["x"]},
+                {"file": ("b.txt", b"content"), "tags": ["x", "y"], "notes": ["note"]},
+                {"name": "c", "link": "c.com"},
+            ]
+        )
+
+        self.assertEqual([2, 3, 4], ids)
+        self.assertEqual([(3, "b.txt"), (2, "a")], arc.find({"tags": ["x"]}, ["id", "name"]))
+        self.assertEqual([(3,)], arc.find({"keyword": "note"}, ["id"]))
+        self.assertEqual([], arc.add_many([]))
+        self.assertEqual(5, arc.add(link="d.com"))
+
+        # Nothing is written if any of the entries is wrong
+        self.assertRaises(Exception, arc.add_many, [{"link": "e.com"}, {"link": "broken link"}])
+        self.assertEqual(5, arc.count({}))
+
+    def test_transaction(self):
+        arc = archive.Archive(":memory:")
+
+        with arc.transaction():
+            id = arc.add(link="a.com")
+            arc.update(id, {"name": ["a"]})
+
+            # Not committed until the scope ends
+            self.assertTrue(arc.db.in_transaction)
+
+        self.assertFalse(arc.db.in_transaction)
+        self.assertEqual([(2, "a")], arc.find({}, ["id", "name"]))
+
+        try:
+            with arc.transaction():
+                arc.add(link="b.com")
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual([(2, "a")], arc.find({}, ["id", "name"]))
+
+    def test_concurrent_reads(self):
+        with tempfile.TemporaryDirectory() as dir:
+            arc = archive.Archive(os.path.join(dir, "archive.db"))
+            self.assertEqual([("wal",)], arc.con.execute("PRAGMA journal_mode").fetchall())
+
+            arc.add(name="a", link="a.com", file=("a.txt", b"content"))
+
+            results = []
+
+            def read_archive():
+                results.append(arc.find({}, ["id"]))
+                results.append(read(arc.get(1, ["file"])[0]))
+
+            with arc.transaction():
+                arc.add(name="b", link="b.com")
+
+                # Other threads read what was committed, without waiting for the transaction
+                thread = threading.Thread(target=read_archive)
+                thread.start()
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+
+                # While this thread sees its own changes
+                self.assertEqual([(2,), (1,)], arc.find({}, ["id"]))
+
+            self.assertEqual([[(1,)], ("a.txt", b"content")], results)
+            self.assertEqual([(2,), (1,)], arc.find({}, ["id"]))
+            arc.close()
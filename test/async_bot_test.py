@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import unittest
+import archive
+import archive_bot
+import async_bot
+
+no_extras = {"author": ["none"]}
+
+
+# Bot that blocks until it's told to continue
+class SlowBot:
+    def __init__(self):
+        self.go = threading.Event()
+
+    def handle_message(self, message, extra):
+        self.go.wait(5)
+        return {"message": message}
+
+
+class TestAsyncBot(unittest.IsolatedAsyncioTestCase):
+    async def test_handle_message(self):
+        arc = archive.Archive(":memory:")
+        bot = async_bot.AsyncArchiveBot(archive_bot.ArchiveBot(arc))
+
+        answer = await bot.handle_message("!add somelink.com tags: [a]", dict(no_extras))
+        self.assertEqual({"type": "add", "generated_id": 1}, answer["edits"])
+
+        answer = await bot.handle_message("!get 1", dict(no_extras))
+        self.assertEqual("https://somelink.com", answer["link"])
+
+        answer = await bot.handle_message("!nothing", dict(no_extras))
+        self.assertIn("error", answer)
+
+        metrics = bot.metrics()
+        self.assertEqual(3, metrics["completed"])
+        self.assertEqual(0, metrics["queued"] + metrics["running"])
+        bot.shutdown()
+
+    async def test_timeout(self):
+        slow = SlowBot()
+        bot = async_bot.AsyncArchiveBot(slow, timeout=0.05)
+
+        answer = await bot.handle_message("!find", {"edits": {"type": "find"}})
+        self.assertEqual({"type": "find"}, answer["edits"])
+        self.assertIn("notice", answer)
+
+        # The call is still running in its thread, and its answer comes later
+        self.assertEqual(1, bot.metrics()["running"])
+        self.assertEqual(1, bot.metrics()["timeouts"])
+
+        slow.go.set()
+        self.assertEqual({"message": "!find"}, await answer["pending"])
+
+        bot.shutdown()
+        self.assertEqual(0, bot.metrics()["running"])
+
+    async def test_busy(self):
+        slow = SlowBot()
+        bot = async_bot.AsyncArchiveBot(slow, workers=1, max_queue=2)
+
+        # The event loop keeps running while the bot works
+        first = asyncio.ensure_future(bot.handle_message("one", {}))
+        second = asyncio.ensure_future(bot.handle_message("two", {}))
+        await asyncio.sleep(0.01)
+
+        self.assertIn("error", await bot.handle_message("three", {}))
+        self.assertEqual(1, bot.metrics()["queued"])
+        self.assertEqual(1, bot.metrics()["running"])
+
+        slow.go.set()
+        self.assertEqual([{"message": "one"}, {"message": "two"}], [await first, await second])
+
+        metrics = bot.metrics()
+        self.assertEqual((1, 2), (metrics["rejected"], metrics["max_depth"]))
+        bot.shutdown()
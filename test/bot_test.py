@@ -1,3 +1,4 @@
+import io
 import unittest
 import archive
 import archive_bot
@@ -23,7 +24,7 @@ class TestBot(unittest.TestCase):
 
         # Add a complete entry
         assert not "error" in bot.handle_message(
-            "!add link name: link tags: [a, b, c] read: someone",
+            "!add otherlink name: link tags: [a, b, c] read: someone",
             {"author": ["none"], "file": ("filename.txt", b"some content")},
         )
 
@@ -56,6 +57,117 @@ class TestBot(unittest.TestCase):
             '!update 1 tags: +[c, d] -e link: "otherlink.com" name: name', no_extras
         )
 
+    def test_inline_parameters(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        bot.handle_message("!add link.com tags:foo score:5", no_extras)
+        self.assertEqual(["foo"], bot.get_resume(1)["tags"])
+        self.assertEqual(["5"], bot.get_resume(1)["score"])
+
+        bot.handle_message("!update 1 name:renamed", no_extras)
+        self.assertEqual("renamed", bot.get_resume(2)["name"])
+
+        # Other named tags written the same way are tags
+        bot.handle_message("!add x.com rating:5 year:2020", no_extras)
+        self.assertEqual(["5"], bot.get_resume(3)["rating"])
+        self.assertEqual(["2020"], bot.get_resume(3)["year"])
+
+        bot.handle_message("!update 3 read:someone", no_extras)
+        self.assertEqual(["someone"], bot.get_resume(4)["read"])
+        self.assertEqual(["5"], bot.get_resume(4)["rating"])
+
+    def test_duplicate_links(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        result = bot.handle_message('!add "https://www.Example.com/page/" tags: a', no_extras)
+
+        # The same link, written some other way
+        for link in ["example.com/page", "http://example.com/page#top", "https://www.example.com/page"]:
+            duplicate = bot.handle_message('!add "%s"' % link, no_extras)
+            self.assertEqual("Already archived as #1", duplicate["error"])
+
+        self.assertFalse("error" in bot.handle_message('!add "example.com/other"', no_extras))
+
+        # Editing the message that added a link can keep the link
+        edits = {"type": "add", **result["edits"]}
+        result = bot.handle_message(
+            '!add "example.com/page" tags: b', {"author": ["none"], "edits": edits}
+        )
+        self.assertEqual(3, result["id"])
+
+        # Once updated to some other link, the old one is free again
+        bot.handle_message('!update 3 link: "example.com/moved"', no_extras)
+        self.assertFalse("error" in bot.handle_message('!add "example.com/page"', no_extras))
+
+    def test_facets(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        for i, author in enumerate(["ann", "bob", "ann", "cy", "ann", "bob"]):
+            bot.handle_message("!add link%d.com tags: author:%s score:%d" % (i, author, i % 2), no_extras)
+
+        rows, keys = bot.handle_message("!facets author", no_extras)["table"]
+        self.assertEqual(["author", "entries"], keys)
+        self.assertEqual([["ann", 3], ["bob", 2], ["cy", 1]], rows)
+
+        # Counts follow updates and edits
+        bot.handle_message("!update 1 tags: -author:ann +author:cy", no_extras)
+        rows, _keys = bot.handle_message("!facets author", no_extras)["table"]
+        self.assertEqual([["ann", 2], ["bob", 2], ["cy", 2]], rows)
+
+        rows, keys = bot.handle_message("!facets", no_extras)["table"]
+        self.assertEqual(["key", "values", "entries"], keys)
+        self.assertEqual([["added_by", 1, 6], ["author", 3, 6], ["score", 2, 6]], rows)
+
+    def test_find_patterns(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        bot.handle_message("!add link1.com tags: proj-web author:ann", no_extras)
+        bot.handle_message("!add link2.com tags: proj-db", no_extras)
+        bot.handle_message("!add link3.com tags: other author:bob", no_extras)
+
+        rows, keys = bot.handle_message("!find tags: proj-* -author:?", no_extras)["table"]
+        self.assertEqual([2], [row[0] for row in rows])
+
+        rows, keys = bot.handle_message("!find tags: author:?", no_extras)["table"]
+        self.assertEqual([3, 1], [row[0] for row in rows])
+
+        # Name and link filters take a single value
+        bot.handle_message("!add link4.com name: foo", no_extras)
+
+        rows, keys = bot.handle_message("!find name: fo", no_extras)["table"]
+        self.assertEqual([4], [row[0] for row in rows])
+
+        rows, keys = bot.handle_message("!find link: link2", no_extras)["table"]
+        self.assertEqual([2], [row[0] for row in rows])
+
+        answer = bot.handle_message("!find name: +a -b", no_extras)
+        self.assertEqual("Cannot add or remove values of name", answer["error"])
+
+        # Numbers are tags like any other
+        answer = bot.handle_message("!find tags: 2020", no_extras)
+        self.assertEqual([], answer["table"][0])
+
+    def test_find_numbers(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        for i, score in enumerate(["3", "5", "4.5", "1"]):
+            bot.handle_message("!add link%d.com score: %s" % (i, score), no_extras)
+
+        rows, keys = bot.handle_message("!find score: >=4 order: score desc", no_extras)["table"]
+        self.assertEqual([2, 3], [row[0] for row in rows])
+        self.assertEqual([["5"], ["4.5"]], [row[keys.index("score")] for row in rows])
+
+        rows, keys = bot.handle_message("!find score: >1 <4.5", no_extras)["table"]
+        self.assertEqual([1], [row[0] for row in rows])
+
+        self.assertTrue("error" in bot.handle_message("!find score: >=high", no_extras))
+        self.assertTrue("error" in bot.handle_message("!find score: >=4 5", no_extras))
+
     def test_find(self):
         arc = archive.Archive(":memory:")
         bot = archive_bot.ArchiveBot(arc)
@@ -65,9 +177,67 @@ class TestBot(unittest.TestCase):
         bot.handle_message("!add test name: name tags: [%s]" % tags, no_extras)
 
         # Add a bunch of entries to force multiple pages
-        for _ in range(20):
-            bot.handle_message("!add test", no_extras)
+        for i in range(20):
+            bot.handle_message("!add test%d" % i, no_extras)
 
         assert not "error" in bot.handle_message("!find", no_extras)
         assert not "error" in bot.handle_message("!find page: 1", no_extras)
         assert not "error" in bot.handle_message("!find page: 2", no_extras)
+        assert not "error" in bot.handle_message("!find since: 7d order: ctime asc", no_extras)
+        assert not "error" in bot.handle_message('!find until: "2020-05-01" order: name', no_extras)
+        assert "error" in bot.handle_message("!find since: yesterday", no_extras)
+
+    def test_find_pages(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        for i in range(15):
+            bot.handle_message("!add link%d.com" % i, no_extras)
+
+        # One column per field, plus the added_by named tag
+        dots = ["..."] * 5
+
+        rows, _keys = bot.handle_message("!find", no_extras)["table"]
+        self.assertEqual(11, len(rows))
+        self.assertEqual(15, rows[0][0])
+        self.assertEqual(dots, rows[-1])
+
+        rows, _keys = bot.handle_message("!find page: 2", no_extras)["table"]
+        self.assertEqual(dots, rows[0])
+        self.assertEqual([5, 4, 3, 2, 1], [row[0] for row in rows[1:]])
+
+        rows, _keys = bot.handle_message("!find after: 3", no_extras)["table"]
+        self.assertEqual([dots, 2, 1], [rows[0], rows[1][0], rows[2][0]])
+
+        answer = bot.handle_message("!find after: abc", no_extras)
+        self.assertEqual("Can only continue after an entry id", answer["error"])
+
+    def test_add_many_files(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        files = [("a.txt", io.BytesIO(b"a")), ("b.txt", io.BytesIO(b"b"))]
+        result = bot.handle_message("!add tags: [x]", {"author": ["none"], "file": files})
+
+        self.assertEqual("#1, #2", result["entries"])
+        self.assertEqual([1, 2], result["edits"]["generated_ids"])
+        self.assertEqual([(2, "b.txt"), (1, "a.txt")], arc.find({"tags": ["x"]}, ["id", "name"]))
+
+        # Editing the message replaces every entry it added
+        files = [("c.txt", io.BytesIO(b"c"))]
+        edits = {"type": "add", **result["edits"]}
+        result = bot.handle_message("!add tags: [x]", {"author": ["none"], "file": files, "edits": edits})
+
+        self.assertEqual({"type": "add", "generated_id": 3}, result["edits"])
+        self.assertEqual([(3, "c.txt")], arc.find({"tags": ["x"]}, ["id", "name"]))
+
+        # A link goes with the first file only
+        files = [("d.txt", io.BytesIO(b"d")), ("e.txt", io.BytesIO(b"e"))]
+        result = bot.handle_message("!add c.com tags: [y]", {"author": ["none"], "file": files})
+
+        self.assertEqual([4, 5], result["edits"]["generated_ids"])
+        self.assertEqual(
+            [(5, "e.txt", None), (4, "d.txt", "https://c.com")],
+            arc.find({"tags": ["y"]}, ["id", "name", "link"]),
+        )
+        self.assertIn("error", bot.handle_message("!add c.com", {"author": ["none"]}))
@@ -1,6 +1,8 @@
+import os
+import tempfile
 import unittest
 import grammar
-from grammar import Add, Sub
+from grammar import Add, Sub, Compare
 
 g = grammar.build_grammar()
 
@@ -70,3 +72,66 @@ class TestGrammar(unittest.TestCase):
             ],
         )
 
+
+    def test_patterns(self):
+        self.assertEqual(
+            parse("!find tags: proj-* -old-proj-? author:?"),
+            ["find", [("tags", ["proj-*", Sub("old-proj-?"), "author:?"])]],
+        )
+
+        # Dashes in front of a word still remove it
+        self.assertEqual(
+            parse("!update 12-3 tags: a -b"), ["update", ["12-3", ("tags", ["a", Sub("b")])]],
+        )
+
+    def test_compare(self):
+        self.assertEqual(
+            parse("!find score: >=4 <4.5 year:=2020"),
+            [
+                "find",
+                [
+                    ("score", [Compare(">=", 4), Compare("<", "4.5")]),
+                    ("year", [Compare("=", 2020)]),
+                ],
+            ],
+        )
+
+    def test_inline_parameters(self):
+        self.assertEqual(parse("!update 1 name:foo"), ["update", [1, ("name", ["foo"])]])
+
+        self.assertEqual(
+            parse("!add link.com tags:foo score:5"),
+            ["add", ["link.com", ("tags", ["foo", "score:5"])]],
+        )
+
+        self.assertEqual(
+            parse("!find kw page:2 tags: a"), ["find", ["kw", ("page", [2]), ("tags", ["a"])]],
+        )
+
+        # Once a parameter is open, the words after it are its values
+        self.assertEqual(
+            parse("!add link tags: foo name:bar"), ["add", ["link", ("tags", ["foo", "name:bar"])]],
+        )
+
+        # Named tags and quoted text are left alone
+        self.assertEqual(parse("!find score:5"), ["find", ["score:5"]])
+        self.assertEqual(parse('!find "tags:foo"'), ["find", ["tags:foo"]])
+
+    def test_cached_grammar(self):
+        with tempfile.TemporaryDirectory() as dir:
+            cache = os.path.join(dir, "grammar.cache")
+
+            built = grammar.build_grammar(cache)
+            self.assertTrue(os.path.exists(cache))
+
+            loaded = grammar.build_grammar(cache)
+
+            for s in ["!get 123", "!get 123abc", "!find tags : a:b c -d", "!update 1 name:foo"]:
+                self.assertEqual(
+                    grammar.transform(built.parse(s)), grammar.transform(loaded.parse(s))
+                )
+
+            self.assertEqual(
+                grammar.transform(loaded.parse("!find tags : a:b c -d")),
+                ["find", [("tags", ["a:b", "c", Sub("d")])]],
+            )
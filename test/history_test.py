@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+import history
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEditHistory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.dir.name, "history.db")
+        self.clock = Clock()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_get(self):
+        edits = history.EditHistory(self.db_file, clock=self.clock)
+
+        edits.put(1, 10, 100, {"type": "add", "generated_id": 5})
+        edits.put(2, 10, 101, None)
+
+        self.assertEqual((10, 100, {"type": "add", "generated_id": 5}), edits.get(1))
+        self.assertEqual((10, 101, None), edits.get(2))
+        self.assertEqual(None, edits.get(3))
+
+        # Updating a record replaces it
+        edits.put(1, 10, 100, {"type": "find"})
+        self.assertEqual((10, 100, {"type": "find"}), edits.get(1))
+
+    def test_capacity(self):
+        edits = history.EditHistory(self.db_file, capacity=2, clock=self.clock)
+
+        edits.put(1, 10, 100, None)
+        edits.put(2, 10, 101, None)
+        edits.get(1)
+        edits.put(3, 10, 102, None)
+
+        # The least recently used record leaves memory, but is still on disk
+        self.assertEqual([1, 3], list(edits.cache))
+        self.assertEqual((10, 101, None), edits.get(2))
+        self.assertEqual(2, len(edits))
+
+    def test_ttl(self):
+        edits = history.EditHistory(self.db_file, ttl=60, clock=self.clock)
+
+        edits.put(1, 10, 100, None)
+        self.clock.now += 30
+        edits.put(2, 10, 101, None)
+        self.clock.now += 45
+
+        self.assertEqual(None, edits.get(1))
+        self.assertEqual((10, 101, None), edits.get(2))
+
+        edits.expire()
+        rows = edits.con.execute("SELECT message_id FROM edit_history").fetchall()
+        self.assertEqual([(2,)], rows)
+
+    def test_persistent(self):
+        edits = history.EditHistory(self.db_file, clock=self.clock)
+        edits.put(1, 10, 100, {"type": "update", "generated_id": 7})
+        edits.close()
+
+        edits = history.EditHistory(self.db_file, clock=self.clock)
+        self.assertEqual(0, len(edits))
+        self.assertEqual((10, 100, {"type": "update", "generated_id": 7}), edits.get(1))
+        edits.close()
+
+    def test_no_sync_on_put(self):
+        edits = history.EditHistory(self.db_file, clock=self.clock)
+
+        # Commits don't wait for the disk, put runs on the event loop
+        self.assertEqual(("wal",), edits.con.execute("PRAGMA journal_mode").fetchone())
+        self.assertEqual((1,), edits.con.execute("PRAGMA synchronous").fetchone())
+        edits.close()
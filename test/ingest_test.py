@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+import unittest
+import ingest
+
+
+class Attachment:
+    def __init__(self, filename, content, chunk_size=4):
+        self.filename = filename
+        self.size = len(content)
+        self.content = content
+        self.chunk_size = chunk_size
+
+
+# Serves an attachment in small pieces, giving way to the event loop between them
+async def fetch(attachment):
+    content = attachment.content
+
+    for start in range(0, len(content), attachment.chunk_size):
+        await asyncio.sleep(0)
+        yield content[start : start + attachment.chunk_size]
+
+
+class TestIngest(unittest.IsolatedAsyncioTestCase):
+    async def test_ingest(self):
+        attachments = [Attachment("a.txt", b"first file"), Attachment("b.txt", b"second one")]
+
+        uploads = await ingest.ingest(attachments, 100, fetch)
+
+        for attachment, (name, file, sha256) in zip(attachments, uploads):
+            self.assertEqual(attachment.filename, name)
+            self.assertEqual(attachment.content, file.read())
+            self.assertEqual(hashlib.sha256(attachment.content).hexdigest(), sha256)
+            file.close()
+
+    async def test_spools_to_disk(self):
+        content = bytes(range(256)) * 16
+        name, file, sha256 = await ingest.spool(
+            "big", fetch(Attachment("big", content, 100)), len(content), spool_size=1024
+        )
+
+        # Past spool_size the content lives in a real file
+        self.assertTrue(file._rolled)
+        self.assertEqual(content, file.read())
+        file.close()
+
+    async def test_too_large(self):
+        fetched = []
+
+        async def tracked_fetch(attachment):
+            fetched.append(attachment.filename)
+            async for chunk in fetch(attachment):
+                yield chunk
+
+        # Refused before reading anything
+        attachments = [Attachment("small", b"ok"), Attachment("big", b"x" * 20)]
+        with self.assertRaises(ingest.TooLarge):
+            await ingest.ingest(attachments, 10, tracked_fetch)
+
+        self.assertEqual([], fetched)
+
+        # The declared size can't be trusted either
+        liar = Attachment("liar", b"x" * 20)
+        liar.size = 5
+        with self.assertRaises(ingest.TooLarge):
+            await ingest.ingest([Attachment("small", b"ok"), liar], 10, fetch)
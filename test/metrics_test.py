@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+import archive
+import archive_bot
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+
+    def find(self, kind, name):
+        for stats in metrics.registry.snapshot():
+            if stats["kind"] == kind and stats["name"] == name:
+                return stats
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+
+        for ms in range(1, 101):
+            histogram.observe(ms / 1000)
+
+        self.assertEqual(100, histogram.count)
+        self.assertAlmostEqual(5.05, histogram.sum)
+
+        # Quantiles are estimated from the buckets, they're only as precise as them
+        self.assertTrue(0.032 <= histogram.quantile(0.5) <= 0.064)
+        self.assertTrue(0.064 <= histogram.quantile(0.95) <= 0.128)
+        self.assertEqual(0.0, metrics.Histogram().quantile(0.5))
+
+    def test_measure(self):
+        registry = metrics.Registry()
+
+        with registry.measure("command", "outer"):
+            registry.statement()
+
+            with registry.measure("archive", "inner"):
+                registry.statement()
+                registry.add_rows(3)
+
+        with self.assertRaises(ValueError):
+            with registry.measure("archive", "inner"):
+                raise ValueError()
+
+        keys = ["name", "count", "errors", "statements", "rows"]
+        inner, outer = [tuple(s[k] for k in keys) for s in registry.snapshot()]
+
+        # The outer scope pays for the work done inside the inner one
+        self.assertEqual(("outer", 1, 0, 2, 3), outer)
+        self.assertEqual(("inner", 2, 1, 1, 3), inner)
+
+    def test_bot(self):
+        arc = archive.Archive(":memory:")
+        bot = archive_bot.ArchiveBot(arc)
+
+        bot.handle_message('!add "link.com" tags: a', {"author": ["none"]})
+        bot.handle_message("!find tags: a", {"author": ["none"]})
+        bot.handle_message("!get 123", {"author": ["none"]})
+        bot.handle_message("!nothing", {"author": ["none"]})
+
+        add = self.find("command", "add")
+        self.assertEqual((1, 0), (add["count"], add["errors"]))
+        self.assertTrue(add["statements"] > 0)
+
+        self.assertEqual(1, self.find("command", "find")["rows"])
+        self.assertEqual(1, self.find("command", "get")["errors"])
+        self.assertEqual(1, self.find("command", "unknown")["errors"])
+        self.assertEqual(1, self.find("archive", "find_page")["count"])
+
+        result = bot.handle_message("!stats", {"author": ["none"]})
+        rows, keys = result["table"]
+
+        self.assertEqual(["add", "find", "get", "unknown"], [row[0] for row in rows])
+        self.assertEqual("count", keys[1])
+
+        result = bot.handle_message("!stats archive", {"author": ["none"]})
+        self.assertIn("add_many", [row[0] for row in result["table"][0]])
+
+    def test_prometheus(self):
+        registry = metrics.Registry()
+        registry.gauge("pool", lambda: {"queued": 2})
+
+        with registry.measure("command", "find"):
+            registry.add_rows(5)
+
+        text = registry.prometheus()
+        self.assertIn('archive_command_seconds_bucket{command="find",le="+Inf"} 1', text)
+        self.assertIn('archive_command_seconds_count{command="find"} 1', text)
+        self.assertIn('archive_command_rows_total{command="find"} 5', text)
+        self.assertIn("archive_pool_queued 2", text)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "metrics.prom")
+            registry.dump(path)
+
+            with open(path) as file:
+                self.assertEqual(text, file.read())
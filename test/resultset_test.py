@@ -0,0 +1,67 @@
+import unittest
+from resultset import ResultSet
+
+
+class TestResultSet(unittest.TestCase):
+    def test_from_rows(self):
+        rows = [(1, "a", "x y"), (2, "b", "z")]
+        results = ResultSet.from_rows(["id", "name", "tags"], rows)
+
+        self.assertEqual(rows, results)
+        self.assertEqual(2, len(results))
+        self.assertEqual("b", results[1]["name"])
+        self.assertEqual((2, "b", "z"), results[-1])
+        self.assertRaises(IndexError, lambda: results[2])
+
+    def test_empty(self):
+        results = ResultSet.from_rows(["id", "name"], [])
+
+        self.assertEqual([], results)
+        self.assertEqual([], results[:10])
+        self.assertEqual([], results.expand("name", lambda name: (name, {"x": 1})))
+
+    def test_slice(self):
+        results = ResultSet.from_rows(["id"], [(i,) for i in range(10)])
+        page = results[2:5]
+
+        self.assertEqual([(2,), (3,), (4,)], page)
+        self.assertEqual([(3,)], page[1:2])
+        self.assertEqual([], results[5:2])
+
+        # Pages share the columns of the set they come from
+        self.assertIs(results.columns, page.columns)
+
+    def test_unpack_once(self):
+        calls = []
+
+        def unpack(value):
+            calls.append(value)
+            return value.split()
+
+        results = ResultSet.from_rows(["id", "tags"], [(1, "a b"), (2, "c")], [None, unpack])
+        page = results[:1]
+
+        self.assertEqual([], calls)
+        self.assertEqual((1, ["a", "b"]), page[0])
+        self.assertEqual([(1, ["a", "b"]), (2, ["c"])], results)
+        self.assertEqual(["a b", "c"], calls)
+
+    def test_expand(self):
+        def split(tags):
+            named = {tag.split(":")[0]: tag.split(":")[1] for tag in tags if ":" in tag}
+            return [tag for tag in tags if ":" not in tag], named
+
+        rows = [(1, "a author:x"), (2, "b score:2"), (3, "c author:y")]
+        results = ResultSet.from_rows(["id", "tags"], rows, [None, str.split])
+        page = results[:2].expand("tags", split)
+
+        self.assertEqual(("id", "tags", "author", "score"), page.keys)
+        self.assertEqual([(1, ["a"], "x", None), (2, ["b"], None, "2")], page)
+
+        # Rows outside the page are left alone
+        self.assertEqual((3, ["c", "author:y"]), results[2])
+
+    def test_sort(self):
+        results = ResultSet.from_rows(["id"], [(3,), (1,), (2,)])
+
+        self.assertEqual([(1,), (2,), (3,)], sorted(results))
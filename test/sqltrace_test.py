@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+import archive
+import archive_bot
+import sqltrace
+
+
+class TestTrace(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(
+            "SELECT id FROM entries WHERE id = ? AND name = ? AND tag IN (?, ...)",
+            sqltrace.normalize(
+                """
+                SELECT id FROM entries -- the table
+                WHERE id = 12 AND name = 'it''s' AND tag IN (?, ?, ?)
+                """
+            ),
+        )
+
+        self.assertEqual(
+            "SELECT entries.id FROM entries_fts WHERE rowid = ?",
+            sqltrace.normalize("SELECT entries.id FROM entries_fts WHERE rowid = 3.5"),
+        )
+
+    def test_tracer(self):
+        with tempfile.TemporaryDirectory() as dir:
+            logged = []
+            tracer = sqltrace.Tracer(threshold=0, log=logged.append)
+            arc = archive.Archive(os.path.join(dir, "test.db"), tracer=tracer)
+
+            arc.add_many([{"link": "link%d.com" % i, "tags": ["a"]} for i in range(3)])
+            self.assertEqual(3, len(arc.find({"tags": ["a"]})))
+            self.assertEqual([], arc.find({"name": "nothing"}, ["id"]))
+
+            shapes = {shape.sql: shape for shape in tracer.report()}
+
+            # Statements run many times share a single shape
+            insert = [sql for sql in shapes if sql.startswith("INSERT INTO entries(")]
+            self.assertEqual(1, len(insert))
+            self.assertEqual(1, shapes[insert[0]].count)
+
+            # Scans are found from the plan
+            (name,) = [sql for sql in shapes if "instr(IFNULL(entries.name" in sql]
+            self.assertTrue(sqltrace.has_scan(shapes[name].plan))
+            self.assertTrue(logged)
+
+            # Every statement is slower than a threshold of 0, the last ones are kept
+            when, sql, params, elapsed, plan = tracer.slow[-1]
+            self.assertEqual(["nothing"], params)
+            self.assertEqual(shapes[name].plan, plan)
+
+            arc.close()
+
+    def test_stats(self):
+        arc = archive.Archive(":memory:", tracer=sqltrace.Tracer(threshold=1))
+        bot = archive_bot.ArchiveBot(arc)
+
+        # !stats shows the slowest statements, which would otherwise include the migrations
+        arc.tracer.shapes.clear()
+
+        bot.handle_message("!find tags: a", {"author": ["none"]})
+        rows, keys = bot.handle_message("!stats sql", {"author": ["none"]})["table"]
+
+        self.assertEqual("statement", keys[0])
+        self.assertTrue(any(row[0].startswith("SELECT entries.id") for row in rows))
+
+        bot = archive_bot.ArchiveBot(archive.Archive(":memory:"))
+        result = bot.handle_message("!stats sql", {"author": ["none"]})
+        self.assertEqual("SQL statements are not being traced", result["error"])
@@ -0,0 +1,75 @@
+import unittest
+import table
+
+
+class TestTable(unittest.TestCase):
+    def test_prepare_value(self):
+        self.assertEqual("abcdefg", table.prepare_value("abcdefg", 10))
+        self.assertEqual("abcd...", table.prepare_value("abcdefghij", 7))
+        self.assertEqual("a, b", table.prepare_value(["b", "a"]))
+        self.assertEqual("", table.prepare_value(None))
+        self.assertEqual("12...", table.prepare_value(123456, 5))
+
+    def test_fit_widths(self):
+        self.assertEqual([2, 5], table.fit_widths([2, 5], 20, 2))
+        self.assertEqual([2, 10, 6], table.fit_widths([2, 30, 6], 22, 2))
+        self.assertEqual([2, 7, 7], table.fit_widths([2, 30, 10], 20, 2))
+        self.assertEqual([3, 3], table.fit_widths([10, 10], 2, 2))
+
+    def test_render(self):
+        rows = [(1, "first", ["b", "a"]), (22, "second\nline", None)]
+        text = table.render(rows, 150, ["id", "name", "tags"])
+
+        self.assertEqual(
+            "\n".join(
+                [
+                    "id  name         tags",
+                    "---------------------",
+                    "1   first        a, b",
+                    "22  second line",
+                ]
+            ),
+            text,
+        )
+
+    def test_render_max_width(self):
+        rows = [(1, "x" * 200, "tag")]
+        text = table.render(rows, 30, ["id", "name", "tags"])
+
+        for line in text.splitlines():
+            self.assertLessEqual(len(line), 30)
+
+        self.assertIn("xxx...", text)
+
+    def test_render_limit(self):
+        rows = [(i, "entry %d" % i) for i in range(1000)]
+        text = table.render(rows, 150, ["id", "name"], limit=200)
+
+        self.assertLessEqual(len(text), 200)
+        self.assertTrue(text.endswith("\n..."))
+        self.assertIn("0   entry 0", text)
+
+    def test_render_stops_early(self):
+        consumed = []
+
+        def rows():
+            for i in range(100000):
+                consumed.append(i)
+                yield (i, "entry")
+
+        text = table.render(rows(), 150, ["id", "name"], limit=100)
+        shown = len(text.splitlines()) - 3
+
+        # Only the rows shown are read, and the one that didn't fit
+        self.assertEqual(shown + 1, len(consumed))
+
+    def test_render_widths(self):
+        rows = [(1, "a"), (2, "b"), (3, "x" * 5000)]
+        text = table.render(rows, 150, ["id", "name"], limit=100)
+
+        # The row that doesn't fit doesn't make the columns wider either
+        self.assertEqual("id  name\n--------\n1   a\n2   b\n...", text)
+
+    def test_render_empty(self):
+        self.assertEqual("id\n--", table.render([], 150, ["id"]))
+        self.assertEqual("", table.render([], 150))